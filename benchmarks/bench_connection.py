@@ -0,0 +1,78 @@
+#
+# benchmarks/bench_connection.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Measures the cost of constructing a Connection, alongside the per
+connection work it used to do: building the command table from dir()
+and hashing a SHA-1 connection id.
+"""
+
+import time
+import random
+import hashlib
+import logging
+import timeit
+
+from optparse import OptionParser
+
+from vsmtpd.connection import Connection
+
+class Socket(object):
+
+    def getsockname(self):
+        return ('127.0.0.1', 25)
+
+class Server(object):
+
+    config = {}
+
+server = Server()
+sock = Socket()
+address = ('127.0.0.1', 34567)
+
+def construct():
+    Connection(server, sock, address)
+
+def legacy_overhead():
+    connection = Connection(server, sock, address)
+    sha_hash = hashlib.sha1(address[0])
+    sha_hash.update(str(time.time()))
+    sha_hash.update(str(random.getrandbits(64)))
+    sha_hash.hexdigest()
+    dict([(c, getattr(connection, c)) for c in dir(connection)
+        if getattr(getattr(connection, c), '_is_command', False)])
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--number', dest='number', type='int',
+        default=20000, help='the number of connections to construct')
+    (options, args) = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    for name, func in (('current', construct), ('legacy', legacy_overhead)):
+        elapsed = min(timeit.repeat(func, number=options.number, repeat=3))
+        print '%-8s %6.2f usec/connection' % (name,
+            elapsed / options.number * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#
+# benchmarks/bench_hooks.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+
+"""
+Measures the cost of firing each of the SMTP phase hooks with 0, 1 and
+10 plugins registered, against the dispatch loop HookManager used before
+the handlers were compiled into tuples.
+"""
+
+import logging
+import timeit
+
+from optparse import OptionParser
+
+from vsmtpd.error import HookError
+from vsmtpd.hooks import hook, HookManager
+
+log = logging.getLogger(__name__)
+
+PHASES = ('connect', 'helo', 'ehlo', 'mail_pre', 'mail', 'rcpt_pre',
+          'rcpt', 'data', 'data_post', 'queue_pre', 'queue', 'queue_post',
+          'quit', 'reset_transaction', 'disconnect')
+
+class Plugin(object):
+
+    @hook(*PHASES)
+    def handler(self, *args):
+        return None
+
+class LegacyHookManager(HookManager):
+
+    def dispatch_hook(self, hook_name, *args, **kwargs):
+        log.debug('dispatching hook %r', hook_name)
+        for cb in self.hooks[hook_name]:
+            try:
+                result = cb(*args, **kwargs)
+                if result:
+                    return result
+            except HookError:
+                raise
+            except Exception as e:
+                log.exception(e)
+                raise
+
+def fire_all(manager):
+    dispatch = manager.dispatch_hook
+    def fire():
+        for hook_name in PHASES:
+            dispatch(hook_name, None)
+    return fire
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--number', dest='number', type='int',
+        default=20000, help='the number of times to fire every hook')
+    (options, args) = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    for plugins in (0, 1, 10):
+        for name, cls in (('current', HookManager),
+                          ('legacy', LegacyHookManager)):
+            manager = cls()
+            for i in xrange(plugins):
+                manager.register_object(Plugin())
+            elapsed = min(timeit.repeat(fire_all(manager),
+                number=options.number, repeat=3))
+            print '%-8s %2d plugins: %6.3f usec/hook' % (name, plugins,
+                elapsed / (options.number * len(PHASES)) * 1e6)
+
+if __name__ == '__main__':
+    main()
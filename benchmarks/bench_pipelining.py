@@ -0,0 +1,119 @@
+#
+# benchmarks/bench_pipelining.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Measures messages/sec for multi-recipient sends against an in-process
+vsmtpd, once with the client waiting for each reply in turn (how every
+client had to talk to vsmtpd before PIPELINING was advertised) and once
+with MAIL, RCPT and DATA sent as a single pipelined batch.
+"""
+
+import time
+import logging
+import collections
+
+from gevent import socket
+from gevent.server import StreamServer
+from optparse import OptionParser
+
+from vsmtpd.daemon import Vsmtpd
+from vsmtpd.hooks import hook
+
+Options = collections.namedtuple('Options', 'config listen port')
+
+BODY = ('Subject: Benchmark\r\nFrom: <bench@example.com>\r\n\r\n' +
+        'This is a benchmark message.\r\n' * 20 + '.\r\n')
+
+class QueuePlugin(object):
+
+    @hook
+    def queue(self, transaction):
+        return True
+
+def read_reply(fp):
+    while True:
+        line = fp.readline()
+        if not line or line[3:4] != '-':
+            return line
+
+def lockstep(fp, sock, recipients):
+    sock.sendall('MAIL FROM:<bench@example.com>\r\n')
+    read_reply(fp)
+    for rcpt in recipients:
+        sock.sendall('RCPT TO:<%s>\r\n' % rcpt)
+        read_reply(fp)
+    sock.sendall('DATA\r\n')
+    read_reply(fp)
+    sock.sendall(BODY)
+    read_reply(fp)
+
+def pipelined(fp, sock, recipients):
+    sock.sendall('MAIL FROM:<bench@example.com>\r\n' +
+                 ''.join(['RCPT TO:<%s>\r\n' % r for r in recipients]) +
+                 'DATA\r\n')
+    for i in xrange(len(recipients) + 2):
+        read_reply(fp)
+    sock.sendall(BODY)
+    read_reply(fp)
+
+def run(address, send, messages, recipients):
+    sock = socket.create_connection(address)
+    fp = sock.makefile()
+    read_reply(fp)
+    sock.sendall('EHLO bench.example.com\r\n')
+    read_reply(fp)
+
+    start = time.time()
+    for i in xrange(messages):
+        send(fp, sock, recipients)
+    elapsed = time.time() - start
+
+    sock.sendall('QUIT\r\n')
+    read_reply(fp)
+    sock.close()
+    return messages / elapsed
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-m', '--messages', dest='messages', type='int',
+        default=2000, help='the number of messages to send')
+    parser.add_option('-r', '--recipients', dest='recipients', type='int',
+        default=10, help='the number of recipients per message')
+    (options, args) = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    vsmtpd = Vsmtpd(Options(None, None, None), [])
+    vsmtpd.hook_manager.register_object(QueuePlugin())
+    server = StreamServer(('127.0.0.1', 0), vsmtpd.handle)
+    server.start()
+
+    recipients = ['rcpt%d@example.com' % i for i in xrange(options.recipients)]
+    for name, send in (('lockstep', lockstep), ('pipelined', pipelined)):
+        rate = run(server.address, send, options.messages, recipients)
+        print '%-10s %d recipients: %8.1f messages/sec' % (name,
+            options.recipients, rate)
+
+    server.stop()
+
+if __name__ == '__main__':
+    main()
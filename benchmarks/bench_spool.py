@@ -0,0 +1,95 @@
+#
+# benchmarks/bench_spool.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Measures the CPU time spent per MB written to a Spool, against the way
+the spool used to work with every write, body included, fed through
+FeedParser.
+"""
+
+import time
+import logging
+
+from cStringIO import StringIO
+from email.feedparser import FeedParser
+from optparse import OptionParser
+
+from vsmtpd.headers import Message
+from vsmtpd.stream import BUFSIZE
+from vsmtpd.spool import Spool
+
+class LegacySpool(object):
+
+    def __init__(self):
+        self._fp = StringIO()
+        self._parser = FeedParser(Message)
+
+    def write(self, data):
+        self._fp.write(data)
+        self._parser.feed(data)
+
+    def end_headers(self):
+        return self._parser.close()
+
+    def close(self):
+        self._fp.close()
+
+def build_message(size):
+    line = 'This is a line of a benchmark message, padded out to 76 chars.\r\n'
+    part = ('--BOUNDARY\r\nContent-Type: text/plain\r\n\r\n' +
+            line * 200)
+    body = part * (size / len(part) + 1)
+    return ('Subject: Benchmark\r\n'
+            'From: <bench@example.com>\r\n'
+            'Content-Type: multipart/mixed; boundary="BOUNDARY"\r\n'
+            '\r\n' + body + '--BOUNDARY--\r\n')
+
+def run(spool_cls, message, blocksize, messages):
+    start = time.clock()
+    for i in xrange(messages):
+        spool = spool_cls()
+        for pos in xrange(0, len(message), blocksize):
+            spool.write(message[pos:pos + blocksize])
+        spool.end_headers()
+        spool.close()
+    return time.clock() - start
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-m', '--messages', dest='messages', type='int',
+        default=20, help='the number of messages to write')
+    parser.add_option('-s', '--size', dest='size', type='int',
+        default=1024 * 1024, help='the size of each message in bytes')
+    parser.add_option('-b', '--blocksize', dest='blocksize', type='int',
+        default=BUFSIZE, help='the size of each write')
+    (options, args) = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    message = build_message(options.size)
+    mb = len(message) * options.messages / 1048576.0
+    for name, spool_cls in (('current', Spool), ('legacy', LegacySpool)):
+        elapsed = run(spool_cls, message, options.blocksize, options.messages)
+        print '%-8s %8.2f msec CPU/MB' % (name, elapsed / mb * 1000)
+
+if __name__ == '__main__':
+    main()
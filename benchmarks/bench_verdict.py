@@ -0,0 +1,88 @@
+#
+# benchmarks/bench_verdict.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+
+"""
+Measures the cost of rejecting a recipient at RCPT, once with the plugin
+raising a DenyError through PluginBase.deny() and once with it returning
+a verdict.
+"""
+
+import logging
+import timeit
+import collections
+
+from optparse import OptionParser
+
+from vsmtpd.connection import Connection
+from vsmtpd.daemon import Vsmtpd
+from vsmtpd.hooks import hook
+from vsmtpd.plugins.plugin import PluginBase
+from vsmtpd.verdict import DENY
+
+Options = collections.namedtuple('Options', 'config listen port')
+
+class RaisingPlugin(PluginBase):
+
+    @hook
+    def rcpt(self, transaction, rcpt):
+        self.deny('No such user')
+
+class VerdictPlugin(PluginBase):
+
+    @hook
+    def rcpt(self, transaction, rcpt):
+        return DENY('No such user')
+
+class Socket(object):
+
+    def getsockname(self):
+        return ('127.0.0.1', 25)
+
+def reject(plugin):
+    vsmtpd = Vsmtpd(Options(None, None, None), [])
+    vsmtpd.hook_manager.register_object(plugin)
+    connection = Connection(vsmtpd, Socket(), ('127.0.0.1', 34567))
+    connection._hello = 'helo'
+    connection.mail('FROM:<bench@example.com>')
+    rcpt = connection.rcpt
+    def run():
+        rcpt('TO:<nobody@example.com>')
+    return run
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--number', dest='number', type='int',
+        default=20000, help='the number of recipients to reject')
+    (options, args) = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    for name, plugin in (('raise', RaisingPlugin()),
+                         ('verdict', VerdictPlugin())):
+        elapsed = min(timeit.repeat(reject(plugin), number=options.number,
+            repeat=3))
+        print '%-8s %6.2f usec/rejection' % (name,
+            elapsed / options.number * 1e6)
+
+if __name__ == '__main__':
+    main()
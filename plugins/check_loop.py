@@ -37,6 +37,7 @@ import logging
 from vsmtpd import dsn
 from vsmtpd.hooks import hook
 from vsmtpd.plugins.plugin import PluginBase
+from vsmtpd.verdict import Verdict
 
 log = logging.getLogger(__name__)
 
@@ -52,10 +53,8 @@ class Plugin(PluginBase):
 
     @hook
     def data_post(self, transaction):
-        hops = 0
-        for key in transaction.headers.keys():
-            if key.lower() in ('received', 'delivered-to'):
-                hops += 1
+        hops = (transaction.header_count('received') +
+                transaction.header_count('delivered-to'))
 
         if hops > self.max_hops:
-            return dsn.too_many_hops()
+            return Verdict(*dsn.too_many_hops())
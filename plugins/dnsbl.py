@@ -25,10 +25,13 @@ dnsbl - handle DNS BlackList lookups
 
 Plugin tha checks the IP address of the incoming connection against a
 configuration set of RBL services.
+
+The lookups are started as soon as the client connects and only waited
+for at RCPT, giving up on any that take longer than ``timeout`` seconds
+(30 by default).
 """
 
 import os
-import gevent
 import logging
 
 from gevent.dns import DNSError
@@ -37,6 +40,7 @@ from gevent.socket import gethostbyname
 from vsmtpd.hooks import hook
 from vsmtpd.plugins.plugin import PluginBase
 from vsmtpd.util import reverse_ip
+from vsmtpd.verdict import DENY, DENY_DISCONNECT
 
 log = logging.getLogger(__name__)
 
@@ -50,24 +54,27 @@ class Plugin(PluginBase):
 
     def __init__(self, config=None):
         self.disconnect = False
+        self.timeout = 30
         if config and 'disconnect' in config:
             self.disconnect = config.getboolean('disconnect')
+        if config and 'timeout' in config:
+            self.timeout = config.getfloat('timeout')
 
     @hook
     def connect(self, connection):
         remote_ip   = connection.remote_ip
         reversed_ip = reverse_ip(remote_ip)
 
-        jobs = []
-        for dnsbl in self.simple_config('dnsbl_zones'):
-            jobs.append(gevent.spawn(check_dnsbl, reversed_ip, dnsbl))
+        zones = list(self.simple_config('dnsbl_zones'))
+        for dnsbl in zones:
+            self.defer(connection, dnsbl, check_dnsbl, reversed_ip, dnsbl,
+                       timeout=self.timeout)
 
-        connection.notes['dnsbl_jobs'] = jobs
+        connection.notes['dnsbl_zones'] = zones
 
     @hook
     def rcpt(self, transaction, rcpt, **param):
-        jobs = transaction.connection.notes.get('dnsbl_jobs')
-        gevent.joinall(jobs)
-        ip = transaction.connection.remote_ip
-        if any([j.value for j in jobs]):
-            self.deny(None, self.disconnect)
+        connection = transaction.connection
+        zones = connection.notes.get('dnsbl_zones', ())
+        if any(self.deferred_result(connection, z) for z in zones):
+            return DENY_DISCONNECT if self.disconnect else DENY
@@ -56,7 +56,8 @@ class Plugin(PluginBase):
 
         msg = transaction.body
 
-        header = smtplib.quotedata(msg.headers.as_string())
+        # The header block goes as it was received, plus our Received
+        header = smtplib.quotedata(transaction.header_block())
         smtp.send(header)
 
         msg.seek(msg.body_start)
@@ -0,0 +1,284 @@
+#
+# vsmtpd/breaker.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+
+"""
+Timeouts and circuit breakers around the hook handlers of a plugin, so
+one that hangs or keeps failing can't hold up every SMTP conversation.
+They are configured in the plugin's section::
+
+    [plugin:queue.smtp_forward]
+    hook_timeout = 30            ; deadline for each of its hook handlers
+    queue_hook_timeout = 120     ; deadline for just its queue handler
+    hook_failure_threshold = 5   ; failures in a row before it is skipped
+    hook_retry_after = 60        ; seconds to skip it before trying again
+    hook_on_failure = denysoft   ; declined, deny or denysoft
+
+The options are all prefixed with hook so they can't be mistaken for the
+plugin's own.
+
+A handler that times out, or is skipped while the breaker is open, is
+treated as having returned the ``hook_on_failure`` verdict. ``declined``, the
+default, fails open by carrying on to the next handler.
+"""
+
+import time
+import gevent
+import logging
+
+from vsmtpd import verdict
+from vsmtpd.error import HookError
+from vsmtpd.hooks import HOOKS
+from vsmtpd.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+FAILURE_VERDICTS = {
+    'declined': None,
+    'deny':     verdict.DENY('Service unavailable'),
+    'denysoft': verdict.DENYSOFT('Service temporarily unavailable'),
+}
+
+GUARD_OPTIONS = ('hook_timeout', 'hook_failure_threshold', 'hook_retry_after',
+                 'hook_on_failure')
+
+def is_guard_option(option):
+    """
+    Check whether a plugin config option belongs to its hook guard rather
+    than the plugin itself.
+
+    :param option: The name of the option
+    :type option: str
+    """
+    return option in GUARD_OPTIONS or option.endswith('_hook_timeout')
+
+class CircuitBreaker(object):
+    """
+    Tracks the failures of a plugin, opening after too many in a row so
+    the plugin is skipped until ``retry_after`` has passed, at which point
+    a single call is let through to probe whether it has recovered.
+
+    :param name: The name of the plugin, for logging
+    :type name: str
+    :keyword threshold: The number of failures in a row to open after
+    :type threshold: int
+    :keyword retry_after: How long to stay open for in seconds
+    :type retry_after: float
+    """
+
+    def __init__(self, name, threshold=5, retry_after=60):
+        self.name        = name
+        self.threshold   = threshold
+        self.retry_after = retry_after
+        self.failures    = 0
+        self.opened      = None
+        self._probing    = False
+
+    @property
+    def open(self):
+        return self.opened is not None
+
+    def allow(self):
+        """
+        Check whether a call to the plugin should go ahead.
+        """
+        if self.opened is None:
+            return True
+        if self._probing or time.time() < self.opened + self.retry_after:
+            return False
+        self._probing = True
+        return True
+
+    def success(self):
+        """
+        Record a call that finished normally, closing the breaker.
+        """
+        if self.opened is not None:
+            log.info('Plugin %s has recovered', self.name)
+        self.failures = 0
+        self.opened = None
+        self._probing = False
+
+    def failure(self):
+        """
+        Record a call that timed out or raised an error.
+        """
+        self.failures += 1
+        if self._probing or (self.threshold and
+                             self.failures >= self.threshold):
+            if not self._probing:
+                log.warning('Plugin %s failed %d times, skipping it for %ds',
+                            self.name, self.failures, self.retry_after)
+                metrics.incr('plugins.breaker_opened')
+            self.opened = time.time()
+            self._probing = False
+
+    def abandon(self):
+        """
+        Forget a call that was killed before it finished, so that if it
+        was probing the plugin another call can probe it instead.
+        """
+        self._probing = False
+
+class GuardedHook(object):
+    """
+    A hook handler called with a deadline and through a circuit breaker.
+
+    :param callback: The hook handler
+    :type callback: func
+    :param hook_name: The hook the handler is registered for
+    :type hook_name: str
+    :param timeout: The deadline in seconds, or None for no deadline
+    :type timeout: float
+    :param breaker: The breaker of the handler's plugin
+    :type breaker: :class:`CircuitBreaker`
+    :param fallback: The result to use when the handler fails
+    :type fallback: :class:`vsmtpd.verdict.Verdict`
+    """
+
+    def __init__(self, callback, hook_name, timeout, breaker, fallback):
+        self.callback  = callback
+        self.hook_name = hook_name
+        self.timeout   = timeout
+        self.breaker   = breaker
+        self.fallback  = fallback
+
+        # Looked at by the hook manager
+        self.im_class       = callback.im_class
+        self._hook_parallel = getattr(callback, '_hook_parallel', False)
+
+    def __eq__(self, other):
+        return self is other or self.callback == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __call__(self, *args, **kwargs):
+        breaker = self.breaker
+        if not breaker.allow():
+            metrics.incr('plugins.skipped')
+            return self.fallback
+
+        timer = gevent.Timeout.start_new(self.timeout) if self.timeout else None
+        recorded = False
+        try:
+            result = self.callback(*args, **kwargs)
+        except HookError:
+            recorded = True
+            breaker.success()
+            raise
+        except gevent.Timeout as e:
+            if e is not timer:
+                raise
+            log.warning('Plugin %s timed out in the %s hook after %ss',
+                        breaker.name, self.hook_name, self.timeout)
+            metrics.incr('plugins.timed_out')
+            recorded = True
+            breaker.failure()
+            return self.fallback
+        except Exception:
+            metrics.incr('plugins.failed')
+            recorded = True
+            breaker.failure()
+            raise
+        else:
+            recorded = True
+            breaker.success()
+            return result
+        finally:
+            if timer is not None:
+                timer.cancel()
+            # Killed by someone else, e.g. the rest of a parallel group
+            # being cancelled or another timeout firing
+            if not recorded:
+                breaker.abandon()
+
+class HookGuard(object):
+    """
+    The timeouts and circuit breaker for the hook handlers of one plugin.
+
+    :param name: The name of the plugin
+    :type name: str
+    :keyword timeout: The default deadline for the plugin's handlers
+    :type timeout: float
+    :keyword timeouts: Deadlines for specific hooks, keyed by hook name
+    :type timeouts: dict
+    :keyword threshold: Failures in a row before the plugin is skipped
+    :type threshold: int
+    :keyword retry_after: How long to skip the plugin for in seconds
+    :type retry_after: float
+    :keyword fallback: The result to use when a handler fails
+    :type fallback: :class:`vsmtpd.verdict.Verdict`
+    """
+
+    def __init__(self, name, timeout=None, timeouts=None, threshold=5,
+                 retry_after=60, fallback=None):
+        self.timeout  = timeout
+        self.timeouts = timeouts or {}
+        self.fallback = fallback
+        self.breaker  = CircuitBreaker(name, threshold, retry_after)
+
+    @classmethod
+    def from_config(cls, name, config):
+        """
+        Create the guard for a plugin from its config section, returning
+        None if the section doesn't configure any of it.
+
+        :param name: The name of the plugin
+        :type name: str
+        :param config: The plugin's config section
+        :type config: :class:`vsmtpd.config.ConfigWrapper`
+        """
+        timeouts = dict([(h, config.getfloat(h + '_hook_timeout'))
+                         for h in HOOKS if (h + '_hook_timeout') in config])
+        if not (timeouts or [k for k in GUARD_OPTIONS if k in config]):
+            return None
+
+        on_failure = 'declined'
+        if 'hook_on_failure' in config:
+            on_failure = config.get('hook_on_failure').lower()
+        if on_failure not in FAILURE_VERDICTS:
+            raise ValueError('hook_on_failure must be one of %s, not %r' % (
+                ', '.join(sorted(FAILURE_VERDICTS)), on_failure))
+
+        return cls(name,
+            timeout=(config.getfloat('hook_timeout')
+                     if 'hook_timeout' in config else None),
+            timeouts=timeouts,
+            threshold=(config.getint('hook_failure_threshold')
+                       if 'hook_failure_threshold' in config else 5),
+            retry_after=(config.getfloat('hook_retry_after')
+                         if 'hook_retry_after' in config else 60),
+            fallback=FAILURE_VERDICTS[on_failure])
+
+    def wrap(self, hook_name, callback):
+        """
+        Wrap one of the plugin's hook handlers.
+
+        :param hook_name: The hook the handler is registered for
+        :type hook_name: str
+        :param callback: The hook handler
+        :type callback: func
+        """
+        timeout = self.timeouts.get(hook_name, self.timeout)
+        return GuardedHook(callback, hook_name, timeout, self.breaker,
+                           self.fallback)
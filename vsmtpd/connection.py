@@ -20,28 +20,74 @@
 #   Boston, MA    02110-1301, USA.
 #
 
+import os
 import time
 import errno
 import gevent
-import random
-import hashlib
 import logging
+import itertools
 
 from email.message import Message
 from email.header import Header
 from email.utils import formatdate
 
 from gevent import socket
-from gevent import Timeout
 
 from vsmtpd import error
+from vsmtpd import resolver
 from vsmtpd.address import Address
 from vsmtpd.commands import parse as parse_command
+from vsmtpd.deferred import Deferred
+from vsmtpd.stream import BUFSIZE, DataDecoder, Stream, format_reply
 from vsmtpd.transaction import Transaction
 from vsmtpd.util import NoteObject
+from vsmtpd.verdict import Verdict
 
 log = logging.getLogger(__name__)
 
+# Replies that never change are encoded once rather than every time they
+# are sent.
+REPLIES = dict([((code, msg), format_reply(code, msg)) for code, msg in (
+    (250, 'OK'),
+    (250, 'Queued'),
+    (354, 'go ahead'),
+    (421, 'Connection timeout, try talking faster next time.'),
+    (451, 'Incomplete DATA'),
+    (451, 'Internal error - try again later'),
+    (500, 'Error: bad syntax'),
+    (500, 'Unrecognized command'),
+    (503, 'MAIL first please'),
+    (503, 'RCPT first please'),
+    (552, 'Message too big!')
+)])
+
+_QUIT_REPLIES = {}
+
+def quit_reply(hostname):
+    """
+    Returns the encoded reply to QUIT for one of our hostnames. There are
+    only ever a few of these so each is encoded once and kept.
+
+    :param hostname: The hostname the server is known by
+    :type hostname: str
+    """
+    reply = _QUIT_REPLIES.get(hostname)
+    if reply is None:
+        reply = _QUIT_REPLIES[hostname] = format_reply(221,
+            '%s closing connection. Have a wonderful day.' % hostname)
+    return reply
+
+_counter = itertools.count()
+
+def connection_id():
+    """
+    Generate a unique identifier for a connection. These are made up of
+    the time, the worker's pid and a per-worker counter so they sort in
+    the order the connections were made.
+    """
+    return '%08x%04x%06x' % (int(time.time()), os.getpid() & 0xffff,
+                             next(_counter) & 0xffffff)
+
 def command(func):
     func._is_command = True
     return func
@@ -65,6 +111,8 @@ class Connection(NoteObject):
         """
         The hostname of the server connection.
         """
+        if self._lhost is None:
+            self._lhost = resolver.local_host(self._lip)
         return self._lhost
 
     @property
@@ -84,8 +132,13 @@ class Connection(NoteObject):
     @property
     def remote_host(self):
         """
-        The hostname of the remote client.
+        The hostname of the remote client. The lookup is started when the
+        connection is accepted and only waited on here if it's needed
+        before it has finished.
         """
+        if self._rhost is None:
+            self._rhost = resolver.get_host(self._rip, self._rhost_job)
+            self._rhost_job = None
         return self._rhost
 
     @property
@@ -122,6 +175,20 @@ class Connection(NoteObject):
     def config(self):
         return self._config
 
+    @property
+    def blob_store(self):
+        """
+        The store message bodies are shared through, if there is one.
+        """
+        return getattr(self._server, 'blob_store', None)
+
+    @property
+    def spool_options(self):
+        """
+        The options used to create the spools messages are received into.
+        """
+        return getattr(self._server, 'spool_options', {})
+
     @property
     def transaction(self):
         return self._transaction
@@ -130,43 +197,102 @@ class Connection(NoteObject):
     def id(self):
         return self._cid
 
+    @property
+    def deadline(self):
+        """
+        The time by which the client has to send what is currently being
+        waited on, None when not waiting on the client.
+        """
+        return self._deadline
+
+    @property
+    def idle_since(self):
+        """
+        When the connection started waiting on the client's next command,
+        None when not waiting on a command.
+        """
+        return self._idle_since
+
+    @property
+    def greenlet(self):
+        """
+        The greenlet handling this connection.
+        """
+        return self._greenlet
+
     def __init__(self, server, sock, address):
         self._rip, self._rport = address
         self._lip, self._lport = sock.getsockname()
         self._server       = server
         self._config       = server.config
         self._socket       = sock
-        self._file         = sock.makefile()
-        self._rhost        = socket.getfqdn(self._rip)
-        self._lhost        = socket.getfqdn(self._lip)
-        self._timeout      = Timeout(30, error.TimeoutError)
+        self._stream       = Stream(sock)
+        self._rhost        = None
+        self._rhost_job    = None
+        self._lhost        = None
+        self._sweeper      = getattr(server, 'sweeper', None)
+        self._greenlet     = None
+        self._deadline     = None
+        self._data_deadline = None
+        self._idle_since   = None
         self._hello        = None
         self._hello_host   = ''
         self._relay_client = False
         self._connected    = True
         self._transaction  = None
+        self._chunking     = False
+        self._deferred     = None
 
-        # Generate a unique identifier for this connection
-        sha_hash = hashlib.sha1(self._rip)
-        sha_hash.update(str(time.time()))
-        sha_hash.update(str(random.getrandbits(64)))
-        self._cid    = sha_hash.hexdigest()
-        log.connection_id = self._cid[:7]
+        # Generate a unique identifier for this connection, the end of it
+        # is what differs between connections in the same second.
+        self._cid    = connection_id()
+        log.connection_id = self._cid[-7:]
 
-        # Add all the command controller methods
-        self._commands = dict([(c, getattr(self, c)) for c in dir(self)
-            if getattr(getattr(self, c), '_is_command', False)])
+        self._commands = self.command_table()
+
+    @classmethod
+    def command_table(cls):
+        """
+        Returns the command controller methods of the class, keyed by
+        command name. This is only worked out once for each class, so
+        subclasses adding commands get a table of their own.
+        """
+        commands = cls.__dict__.get('_command_table')
+        if commands is None:
+            commands = cls._command_table = dict([(c, getattr(cls, c))
+                for c in dir(cls)
+                if getattr(getattr(cls, c), '_is_command', False)])
+        return commands
 
     def accept(self):
-        log.info('Accepted connection from %s', self.remote_host)
-        self.run_hooks('connect', self)
+        log.info('Accepted connection from %s', self.remote_ip)
+        self._rhost_job = resolver.start_lookup(self._rip)
+        self._greenlet = gevent.getcurrent()
+        self._sweeper.add(self)
+        try:
+            self._accept()
+        finally:
+            self._sweeper.remove(self)
+            self.cancel_deferred()
+            if self._transaction:
+                self._transaction.close()
+
+    def _accept(self):
+        verdict = self.run_hooks('connect', self)
+        if isinstance(verdict, Verdict) and not (verdict.okay or verdict.done):
+            return self.disconnect(421 if verdict.soft else 554,
+                verdict.message or 'Connection refused')
+
         self.send_code(220, self.greeting())
 
+        timeout = self._sweeper.greeting
         while True:
-            line = self.get_line()
+            line = self.get_line(timeout)
             if not line:
                 break
 
+            timeout = None
+
             parts = line.strip().split(None, 1)
 
             if not parts:
@@ -179,7 +305,7 @@ class Connection(NoteObject):
                 if not command:
                     response = self.unknown(*parts)
                 else:
-                    response = command(parts[1] if parts[1:] else '')
+                    response = command(self, parts[1] if parts[1:] else '')
 
             except Exception as e:
                 log.exception(e)
@@ -188,6 +314,13 @@ class Connection(NoteObject):
                 finally:
                     break
 
+            # The command has already dealt with replying to the client,
+            # and may have disconnected it too
+            if response is None:
+                if not self._connected:
+                    break
+                continue
+
             # Handle the response from the command
             try:
                 code, msg, disconnect = response
@@ -222,14 +355,13 @@ class Connection(NoteObject):
         if self.hello:
             return 503, 'But you already said HELO...'
 
-        try:
-            self.run_hooks('helo', self, line)
-
-        except error.HookError as e:
-            if not (e.okay or e.done):
-                return 450 if e.soft else 550, e.message, e.disconnect
+        verdict = self.run_hooks('helo', self, line)
+        if isinstance(verdict, Verdict):
+            if not (verdict.okay or verdict.done):
+                return (450 if verdict.soft else 550, verdict.message,
+                        verdict.disconnect)
 
-            if not e.okay:
+            if not verdict.okay:
                 return
 
         self._hello = 'helo'
@@ -245,21 +377,20 @@ class Connection(NoteObject):
         if self.hello:
             return 503, 'But you already said HELO...'
 
-        try:
-            self.run_hooks('ehlo', self, line)
-
-        except error.HookError as e:
-            if not (e.okay or e.done):
-                return 450 if e.soft else 550, e.message, e.disconnect
+        verdict = self.run_hooks('ehlo', self, line)
+        if isinstance(verdict, Verdict):
+            if not (verdict.okay or verdict.done):
+                return (450 if verdict.soft else 550, verdict.message,
+                        verdict.disconnect)
 
-            if not e.okay:
+            if not verdict.okay:
                 return
 
         self._hello = 'ehlo'
         self._hello_host = line
 
 
-        args = []
+        args = ['PIPELINING', 'CHUNKING']
         size_limit = self._config.getint('size_limit')
         if size_limit:
             args.append('SIZE %d' % size_limit)
@@ -312,29 +443,36 @@ class Connection(NoteObject):
         if 'size' in params:
             try:
                 size = int(params['size'])
-            except TypeError:
+            except ValueError:
                 size = 0
 
             size_limit = self.config.getint('size_limit')
-            if self.hello == 'ehlo' and size_limit < size:
+            if self.hello == 'ehlo' and size_limit and size_limit < size:
                 log.info('Message too large to receive, declining')
                 return 552, 'Message too big!'
 
+            # Never more than the message is allowed to be
+            if size_limit:
+                size = min(size, size_limit)
+            self.transaction.declared_size = max(size, 0)
+
         tnx = self.transaction
-        try:
-            addr = self.run_hooks('mail_pre', tnx, addr, params) or addr
-        except error.HookError as e:
-            pass
+        result = self.run_hooks('mail_pre', tnx, addr, params)
+        if result and not isinstance(result, Verdict):
+            addr = result
 
         log.debug('from email address: [%s]', addr)
 
         # Turn addr into an Address object now
         addr = Address(addr)
 
-        try:
-            msg = self.run_hooks('mail', tnx, addr, params)
-        except error.HookError as e:
-            return 450 if e.soft else 550, e.message, e.disconnect
+        verdict = self.run_hooks('mail', tnx, addr, params)
+        if isinstance(verdict, Verdict) and not verdict.okay:
+            if verdict.done:
+                return
+
+            return (450 if verdict.soft else 550, verdict.message,
+                    verdict.disconnect)
 
         log.info('getting from from %s', addr)
         tnx.sender = addr
@@ -373,44 +511,47 @@ class Connection(NoteObject):
                 params[key.lower()] = value
 
         tnx = self.transaction
-        try:
-            addr = self.run_hooks('rcpt_pre', tnx, addr) or addr
-        except error.HookError as e:
-            pass
+        result = self.run_hooks('rcpt_pre', tnx, addr)
+        if result and not isinstance(result, Verdict):
+            addr = result
 
         log.debug('to email address: [%s]', addr)
 
-        try:
-            msg = self.run_hooks('rcpt', tnx, addr)
+        verdict = self.run_hooks('rcpt', tnx, addr)
+        if isinstance(verdict, Verdict) and not verdict.okay:
+            if verdict.done:
+                return
 
-        except error.StopHooksError as e:
-            return
+            return (450 if verdict.soft else 550,
+                    verdict.message or 'relaying denied',
+                    verdict.disconnect)
 
-        except error.HookError as e:
-            return (450 if e.soft else 550,
-                    e.message or 'relaying denied',
-                    e.disconnect)
-        else:
-            #if not msg:
-            #    return self.send_code(450,
-            #        'No plugin decided if relaying is allowed')
+        #if not verdict:
+        #    return self.send_code(450,
+        #        'No plugin decided if relaying is allowed')
 
-            self.transaction.add_recipient(addr)
-            return 250, '%s, recipient ok' % addr
+        self.transaction.add_recipient(addr)
+        return 250, '%s, recipient ok' % addr
 
     @command
     def vrfy(self, line):
-        try:
-            message = self.run_hooks('vrfy')
-        except error.DenyError as e:
-            self.send_code(554, e.message or 'Access Denied')
-            self.reset_transaction()
-        else:
-            if message:
-                return 250, 'User OK' if message == True else message
+        message = self.run_hooks('vrfy')
+        if isinstance(message, Verdict):
+            if message.done:
+                return
+
+            if not message.okay:
+                self.send_code(554, message.message or 'Access Denied')
+                self.reset_transaction()
+                return
 
-            return (252,
-                "Just try sending a mail and we'll see how it turns out...")
+            message = message.message or True
+
+        if message:
+            return 250, 'User OK' if message == True else message
+
+        return (252,
+            "Just try sending a mail and we'll see how it turns out...")
 
     @command
     def rset(self, line):
@@ -425,24 +566,16 @@ class Connection(NoteObject):
         :param line: The rest of the command line
         :type line: str
         """
-        try:
-            message = self.run_hooks('data')
-        except error.HookError as e:
+        if self._chunking:
+            return 503, 'DATA not allowed during a BDAT transfer'
 
+        done, response = self._data_hook()
+        if done:
             # A plugin handled receiving the data
-            if e.done:
-                return
-
-            message = e.message or ('Message denied temporarily' if
-                e.soft else 'Message denied')
+            return
 
-            # Handle any denials
-            if e.deny and e.soft and e.disconnect:
-                return 421, message, True
-            elif e.deny and e.soft:
-                return 451, message
-            elif e.deny:
-                return 554, message, e.disconnect
+        if response:
+            return response
 
         # Begin handling of receiving the message
         if not self.transaction.sender:
@@ -453,84 +586,188 @@ class Connection(NoteObject):
 
         self.send_code(354, 'go ahead')
 
-        # Cancel the timeout
-        self._timeout.cancel()
-
-        buf = ''
         size = 0
         size_limit = self.config.getint('size_limit')
-        in_header = True
-        complete = False
-        lines = 0
+        too_big = False
 
         body = self.transaction.body
+        decoder = DataDecoder()
 
-        log.debug('size: %d / %d', size, size_limit)
+        if self._sweeper.data:
+            self._data_deadline = self._sweeper.now + self._sweeper.data
 
-        line = self.get_line()
-        while line:
-            # Check to see if it is the last line
-            if line == '.\r\n':
-                complete = True
-                break
+        try:
+            while not decoder.done:
+                block = self.get_block(BUFSIZE)
+                if not block:
+                    break
 
-            lines += 1
+                data = decoder.feed(block)
+
+                # Reject messages that have bare LF. Thanks to qpsmtpd
+                # for this tip.
+                if decoder.bare_lf:
+                    return (421,
+                        'See http://smtpd.develooper.com/barelf.html', True)
+
+                # Check to make sure that no naughty clients ignored our
+                # size advertisement at the beginning. The rest of the
+                # message still has to be read before replying.
+                size += len(data)
+                if too_big or (size_limit and size >= size_limit):
+                    too_big = True
+                    continue
+
+                # Write the email data out to the spool, the end of the
+                # headers is picked up by the spool itself.
+                body.write(data)
+        finally:
+            self._data_deadline = None
 
-            # Reject messages that have either bare LF or CR. Thanks to
-            # qpsmtpd for this tip.
-            if line == '.\n' or line == '.\r':
-                return (421,
-                    'See http://smtpd.develooper.com/barelf.html', True)
+        # Connection is probably dead at this point
+        if not decoder.done:
+            self.reset_transaction()
+            return 451, 'Incomplete DATA'
 
-            # Increase the data size of this email
-            size += len(line)
+        # Anything after the end of the message is the next command
+        self._stream.unread(decoder.rest)
 
-            # Check to make sure that no naughty clients ignored our size
-            # advertisement at the beginning.
-            if size_limit and size >= size_limit:
-                self.reset_transaction()
-                return 552, 'Message too big!'
+        if too_big:
+            self.reset_transaction()
+            return 552, 'Message too big!'
 
-            # Write the email data out to the spool
-            body.write(line)
+        return self.data_complete()
 
-            # End the headers
-            if in_header and line == '\r\n':
-                in_header = False
-                body.end_headers()
+    @command
+    def bdat(self, line):
+        """
+        This method handles the BDAT command from the CHUNKING extension
+        (RFC 3030). The chunk is read in large blocks straight into the
+        message spool, there is no line handling or dot-unstuffing.
 
-            log.debug('size: %d / %d', size, size_limit)
+        :param line: The rest of the command line
+        :type line: str
+        """
+        parts = line.split()
+        if (not parts or len(parts) > 2 or not parts[0].isdigit() or
+                [p.upper() for p in parts[1:]] not in ([], ['LAST'])):
+            # Without the chunk size there is no way of telling where the
+            # chunk ends and the next command begins.
+            return 501, 'Syntax error in parameters', True
+
+        size = int(parts[0])
+        last = len(parts) == 2
+
+        # Any errors still require the chunk to be read so the client and
+        # server stay in step with each other.
+        done = False
+        response = None
+        if not self.transaction or not self.transaction.sender:
+            response = 503, 'MAIL first please'
+        elif not self.transaction.recipients:
+            response = 503, 'RCPT first please'
+        elif not self._chunking:
+            done, response = self._data_hook()
+            self._chunking = not (done or response)
+
+            # The data timeout covers the whole transfer, from the first
+            # chunk through to the last, including the commands between.
+            if self._chunking and self._sweeper.data:
+                self._data_deadline = self._sweeper.now + self._sweeper.data
+
+        body = None if done or response else self.transaction.body
+        size_limit = self.config.getint('size_limit')
 
-            line = self.get_line()
+        remaining = size
+        while remaining:
+            block = self.get_block(remaining)
+            if not block:
+                # The client has disconnected
+                self.reset_transaction()
+                return
 
-        # Connection is probably dead at this point
-        if not complete:
+            remaining -= len(block)
+            if body is None:
+                continue
+
+            if size_limit and self.transaction.data_size + len(block) > size_limit:
+                self.reset_transaction()
+                response = 552, 'Message too big!'
+                body = None
+                continue
+
+            body.write(block)
+
+        if done:
+            # A plugin has taken over the message and replied itself, as
+            # with DATA, so the chunk is thrown away and nothing queued.
             self.reset_transaction()
-            return 451, 'Incomplete DATA'
+            return
 
+        if response:
+            return response
 
-        body.headers.insert_header(0, 'Received', self.received_line())
+        if not last:
+            return 250, '%d octets received' % size
 
-        try:
-            self.run_hooks('data_post', self._transaction)
-        except error.HookError as e:
-            if e.done:
+        self._chunking = False
+        self._data_deadline = None
+        return self.data_complete()
+
+    def data_complete(self):
+        """
+        Finish receiving a message, after the end of the DATA or the last
+        BDAT chunk, and pass it on to be queued.
+        """
+        body = self.transaction.body
+        body.end_headers()
+        body.headers.prepend_header('Received', self.received_line())
+
+        verdict = self.run_hooks('data_post', self._transaction)
+        if isinstance(verdict, Verdict) and not verdict.okay:
+            if verdict.done:
                 return
 
-            if e.soft:
+            if verdict.soft:
                 code = 452
                 message = 'Message denied temporarily'
             else:
                 code = 552
                 message = 'Message denied'
 
-            if not e.disconnect:
-                self.reset_transasction()
+            if not verdict.disconnect:
+                self.reset_transaction()
 
-            return code, message, e.disconnect
+            return code, message, verdict.disconnect
 
         return self.queue(self._transaction)
 
+    def _data_hook(self):
+        """
+        Runs the data hook, returning whether a plugin has taken over
+        receiving the message and the response to send, if any.
+        """
+        verdict = self.run_hooks('data')
+        if isinstance(verdict, Verdict):
+            if verdict.done:
+                return True, None
+
+            if verdict.okay:
+                return False, None
+
+            message = verdict.message or ('Message denied temporarily' if
+                verdict.soft else 'Message denied')
+
+            # Handle any denials
+            if verdict.soft and verdict.disconnect:
+                return False, (421, message, True)
+            elif verdict.soft:
+                return False, (451, message)
+            else:
+                return False, (554, message, verdict.disconnect)
+
+        return False, None
+
     def queue(self, transaction):
         """
         Handle the queuing of a message
@@ -539,73 +776,60 @@ class Connection(NoteObject):
         :type transaction: :class:`vsmtpd.transaction.Transction`
         """
 
-        try:
-            self.run_hooks('queue_pre', self._transaction)
-        except error.HookError as e:
-            if e.done:
-                return
+        verdict = self.run_hooks('queue_pre', self._transaction)
+        if isinstance(verdict, Verdict) and verdict.done:
+            return
 
-        try:
-            msg = self.run_hooks('queue', self._transaction)
-        except error.HookError as e:
-            if e.done:
+        msg = self.run_hooks('queue', self._transaction)
+        if isinstance(msg, Verdict):
+            if msg.done:
                 return
 
-            if e.deny:
-                code = 552
-                message = e.message or 'Message denied'
-            elif e.denysoft:
-                code = 452
-                message = e.message or 'Message denied temporarily'
-            else:
-                code = 451
+            if msg.soft:
+                return 452, msg.message or 'Message denied temporarily'
+            elif not msg.okay:
+                return 552, msg.message or 'Message denied'
+
+            msg = msg.message or True
 
         if not msg:
             return 451, 'Queuing declined or disabled; try again later'
 
         self.send_code(250, 'Queued' if msg is True else msg)
 
-        try:
-            self.run_hooks('queue_post', self._transaction)
-        except error.HookError as e:
-            if e.done:
-                return
+        self.run_hooks('queue_post', self._transaction)
 
     @command
     def quit(self, line):
-        msg = ''
-
-        try:
-            msg = self.run_hooks('quit', self)
-
-        except error.HookError as e:
-            if e.done:
+        msg = self.run_hooks('quit', self)
+        if isinstance(msg, Verdict):
+            if msg.done:
                 return self._disconnect()
 
-            if e.message:
-                msg = e.message
-            else:
-                msg = ''
+            msg = msg.message or ''
 
         if not msg:
-            msg = ('%s closing connection. Have a wonderful day.' %
-                self.hostname)
+            self.send_reply(quit_reply(self.hostname))
+            return self._disconnect()
 
         return 221, msg, True
 
     def unknown(self, command, *parts):
-        try:
-            result = self.run_hooks('unknown', self._transaction, command, *parts)
-            if not result:
-                return 500, 'Unrecognized command'
-        except error.DenyDisconnectError as e:
-            return 521, e.message, True
-        except error.DenyError as e:
-            return 500, e.message, True
-        except error.HookError as e:
-            if not e.done:
+        result = self.run_hooks('unknown', self._transaction, command, *parts)
+        if not result:
+            return 500, 'Unrecognized command'
+
+        if isinstance(result, Verdict):
+            if result.done:
+                return
+
+            if result.okay or result.soft:
                 return 500, 'Unrecognized command'
 
+            if result.disconnect:
+                return 521, result.message, True
+            return 500, result.message, True
+
     def disconnect(self, code, message=''):
         """
         Disconnects the client in a timely fashion. Sending the client a
@@ -628,6 +852,7 @@ class Connection(NoteObject):
             return
 
         try:
+            self._stream.flush()
             self._socket.shutdown(socket.SHUT_RDWR)
             self._socket.close()
         except socket.error as e:
@@ -638,24 +863,63 @@ class Connection(NoteObject):
         # correctly.
         self._connected = False
 
-    def get_line(self):
+    def get_line(self, timeout=None):
+        """
+        Read a line from the client, returns None if the client has gone
+        away or timed out.
+
+        :keyword timeout: Seconds to wait, defaults to the command timeout
+        :type timeout: int
+        """
+        if timeout is None:
+            timeout = self._sweeper.command
+        self._idle_since = self._sweeper.now
+        return self._read(timeout, self._stream.readline)
+
+    def get_block(self, size, timeout=None):
+        """
+        Read a block of up to size bytes from the client, returns None if
+        the client has gone away or timed out.
+
+        :param size: The maximum number of bytes to read
+        :type size: int
+        :keyword timeout: Seconds to wait, defaults to the data block timeout
+        :type timeout: int
+        """
+        if timeout is None:
+            timeout = self._sweeper.data_block
+        return self._read(timeout, self._stream.read, size)
+
+    def _read(self, timeout, func, *args):
+        # Set the deadline for the sweeper to enforce, rather than having
+        # a timer per read.
+        deadline = self._sweeper.now + timeout if timeout else None
+        if self._data_deadline is not None:
+            deadline = min(deadline or self._data_deadline,
+                           self._data_deadline)
+        self._deadline = deadline
+
         try:
-            self._timeout.start()
-            line = self._file.readline()
+            data = func(*args)
 
-            # If there is a line we can return it
-            if line:
-                return line
+            # If there is data we can return it
+            if data:
+                return data
 
-            # If line is None then the client must have disconnected
+            # If there is no data then the client must have disconnected
             log.info('client disconnected')
 
         except socket.error as e:
             log.info('client disconnected')
 
         except error.TimeoutError:
+            self._deadline = None
             self.timeout()
 
+        except error.ReapedError:
+            self._deadline = None
+            self.reap()
+
         except Exception as e:
             log.exception(e)
             try:
@@ -664,7 +928,8 @@ class Connection(NoteObject):
                 pass
 
         finally:
-            self._timeout.cancel()
+            self._deadline = None
+            self._idle_since = None
 
     def greeting(self):
         return '%s ESMTP' % self.local_host
@@ -684,7 +949,18 @@ class Connection(NoteObject):
         """
         if self._transaction:
             self.run_hooks('reset_transaction')
+            self._transaction.close()
         self._transaction = Transaction(self)
+        self._chunking = False
+        self._data_deadline = None
+
+    def reap(self):
+        """
+        Disconnect an idle client to make room for others when the server
+        is close to its connection limit.
+        """
+        log.info('Server busy, disconnecting idle client')
+        self.disconnect(421, 'Server busy, closing idle connection')
 
     def received_line(self):
         smtp = 'ESMTP' if self.hello == 'ehlo' else 'SMTP'
@@ -692,12 +968,64 @@ class Connection(NoteObject):
             (self.remote_host, self.hello_host, self.remote_ip,
             self.hostname, smtp, formatdate()))
 
+    def defer(self, key, func, *args, **kwargs):
+        """
+        Start calling a function in the background so a later hook can
+        pick up the result with :meth:`deferred_result`. Anything still
+        running when the client disconnects is killed.
+
+        :param key: The key the result is stored under
+        :type key: hashable
+        :param func: The function to call
+        :type func: callable
+        :keyword timeout: How long after starting to give up on the result
+        :type timeout: float
+        """
+        timeout = kwargs.pop('timeout', None)
+        if self._deferred is None:
+            self._deferred = {}
+
+        previous = self._deferred.get(key)
+        if previous:
+            previous.cancel()
+
+        deferred = self._deferred[key] = Deferred(func, args, kwargs, timeout)
+        return deferred
+
+    def deferred_result(self, key, default=None):
+        """
+        Get the result of a function started with :meth:`defer`, waiting
+        for it to finish if need be.
+
+        :param key: The key the result is stored under
+        :type key: hashable
+        :keyword default: The value to return if nothing was started
+            under the key or it timed out
+        :type default: object
+        """
+        deferred = self._deferred.get(key) if self._deferred else None
+        if deferred is None:
+            return default
+        return deferred.get(default)
+
+    def cancel_deferred(self):
+        """
+        Kill any functions started with :meth:`defer` that are still
+        running.
+        """
+        if not self._deferred:
+            return
+        for deferred in self._deferred.itervalues():
+            deferred.cancel()
+        self._deferred = None
+
     def run_hooks(self, hook_name, *args, **kwargs):
         return self._server.fire(hook_name, *args, **kwargs)
 
     def send_code(self, code, message='', *args):
         """
-        Send a response back to the SMTP client.
+        Send a response back to the SMTP client. The whole reply is built
+        up and written in one go, regardless of how many lines it has.
 
         :param code: The response code to send
         :type code: int
@@ -705,24 +1033,33 @@ class Connection(NoteObject):
         :type message: str
         :param *args: format parameters
         """
-        if message:
-            message = message % args
-        lines = message.splitlines()
-        lastline = lines[-1:]
-        for line in lines[:-1]:
-            self.send_line('%3.3d-%s' % (code, line))
-        self.send_line('%3.3d %s' % (code, lastline and lastline[0] or ''))
+        if args:
+            reply = format_reply(code, message % args)
+        else:
+            reply = REPLIES.get((code, message)) or format_reply(code, message)
+        self.send_reply(reply)
+
+    def send_reply(self, reply):
+        """
+        Send an already encoded reply back to the SMTP client.
+
+        :param reply: The reply including line endings
+        :type reply: str
+        """
+        self._stream.write(reply)
+        if log.isEnabledFor(logging.INFO):
+            log.info(reply[:-2].replace('\r\n', '\n'))
 
     def send_line(self, line):
         """
-        Send a line back to the SMTP client.
+        Send a line back to the SMTP client. The line is buffered and sent
+        along with any other replies once the client's pipelined commands
+        have all been handled.
 
         :param line: The line to send back to the client
         :type line: str
         """
-        self._file.write(line + '\r\n')
-        self._file.flush()
-        log.info(line)
+        self.send_reply(line + '\r\n')
 
     def send_syntax_error(self):
         """
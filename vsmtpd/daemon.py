@@ -25,6 +25,7 @@ import sys
 import gevent
 import signal
 import logging
+import tempfile
 import vsmtpd.logging_setup
 
 from gevent import socket
@@ -32,16 +33,73 @@ from gevent.pool import Pool
 from gevent.server import StreamServer
 from optparse import OptionParser
 
+from vsmtpd import resolver
+from vsmtpd.breaker import HookGuard, is_guard_option
 from vsmtpd.config import load_config
 from vsmtpd.config import ConfigWrapper
 from vsmtpd.connection import Connection
 from vsmtpd.hooks import HookManager
+from vsmtpd.limits import ConnectionLimiter
+from vsmtpd.metrics import metrics
 from vsmtpd.plugins.manager import PluginManager
+from vsmtpd.spool import MemoryBudget, parse_digests
+from vsmtpd.store import BlobStore
+from vsmtpd.stream import format_reply
+from vsmtpd.timeouts import DeadlineSweeper
 from vsmtpd.util import set_cmdline
 
 log = logging.getLogger(__name__)
 vsmtpd = None
 
+#: Sent to clients turned away because the server is full
+BUSY_REPLY = format_reply(421, 'Too busy, try again later')
+
+#: Sent to clients with too many connections open already
+LIMITED_REPLY = format_reply(421, 'Too many connections, try again later')
+
+def turn_away(sock, reply):
+    """
+    Send a reply to a client that is being turned away, without waiting
+    on the client. This can be called from the hub's accept callback
+    where anything that would block is an error, so a reply that doesn't
+    fit in the socket buffer is simply dropped.
+
+    :param sock: The client socket
+    :type sock: socket
+    :param reply: The encoded reply
+    :type reply: str
+    """
+    try:
+        sock.setblocking(0)
+        sock.send(reply)
+    except Exception as e:
+        # Includes the hub refusing to block, not just socket errors
+        log.debug('Unable to send reply to turned away client: %s', e)
+
+class SheddingServer(StreamServer):
+    """
+    A StreamServer that keeps accepting connections once its pool is full
+    and immediately turns the extra clients away with a 421, rather than
+    leaving them waiting in the listen backlog until they give up.
+    """
+
+    def set_spawn(self, spawn):
+        StreamServer.set_spawn(self, spawn)
+        # Never stop accepting, clients are shed in do_handle instead. This
+        # has to replace the pool's full() that set_spawn installs.
+        self.full = lambda: False
+
+    def do_handle(self, sock, address):
+        if self.pool is None or not self.pool.full():
+            return StreamServer.do_handle(self, sock, address)
+
+        metrics.incr('connections.shed')
+        log.debug('Too busy, rejecting connection from %s', address[0])
+        try:
+            turn_away(sock, BUSY_REPLY)
+        finally:
+            sock.close()
+
 class Vsmtpd(object):
 
     def __init__(self, options, args):
@@ -59,6 +117,60 @@ class Vsmtpd(object):
             self.pool = Pool(connection_limit)
             log.info('Limiting connections to %d', connection_limit)
 
+        # Limit the connections from a single client, this has to be set
+        # up before any workers are forked for the counts to be shared.
+        self.limiter = ConnectionLimiter(
+            self.config.getint('per_ip_connection_limit'),
+            self.config.getint('per_network_connection_limit'),
+            self.config.getboolean('share_connection_limits'))
+
+        # Messages too large to keep in memory are spooled here
+        spool_dir = self.config.get('spool_dir')
+        if spool_dir and not os.path.isdir(spool_dir):
+            log.warning("Spool directory '%s' doesn't exist, using '%s'",
+                        spool_dir, tempfile.gettempdir())
+            spool_dir = None
+
+        # All the spools in a worker share a memory budget
+        self.spool_budget = MemoryBudget(
+            self.config.getint('spool_memory_limit'),
+            self.config.getfloat('spool_memory_pressure'),
+            self.config.getint('spool_rollover'))
+
+        digests = parse_digests(self.config.get('spool_digests'))
+
+        # Identical bodies can be shared through a content-addressed store,
+        # which is keyed by the body digest computed during receipt.
+        self.blob_store = None
+        if self.config.getboolean('spool_store'):
+            self.blob_store = BlobStore(spool_dir or tempfile.gettempdir())
+            if 'body:sha256' not in digests:
+                digests += ('body:sha256',)
+
+        self.spool_options = {
+            'directory': spool_dir,
+            'memfd_limit': self.config.getint('memfd_spool_limit'),
+            'budget': self.spool_budget,
+            'digests': digests
+        }
+
+        # Configure the reverse DNS cache
+        resolver.configure(self.config.getint('dns_cache_size'),
+                           self.config.getint('dns_cache_ttl'),
+                           self.config.getint('dns_negative_ttl'))
+
+        # Create the sweeper that enforces the connection timeouts
+        self.sweeper = DeadlineSweeper(pool=self.pool)
+        self.sweeper.greeting = self.config.getint('greeting_timeout')
+        self.sweeper.command = self.config.getint('command_timeout')
+        self.sweeper.data_block = self.config.getint('data_block_timeout')
+        self.sweeper.data = self.config.getint('data_timeout')
+        self.sweeper.overload_watermark = self.config.getfloat(
+            'overload_watermark')
+        self.sweeper.overload_command = self.config.getint(
+            'overload_command_timeout')
+        self.sweeper.reap_watermark = self.config.getfloat('reap_watermark')
+
         # Create the hook manager
         self.hook_manager = HookManager()
 
@@ -70,10 +182,18 @@ class Vsmtpd(object):
         return self.hook_manager.dispatch_hook(hook_name, *args, **kwargs)
 
     def handle(self, socket, address):
-        connection = Connection(self, socket, address)
-        connection.run_hooks('pre_connection', connection)
-        connection.accept()
-        connection.run_hooks('post_connection', connection)
+        if not self.limiter.acquire(address[0]):
+            metrics.incr('connections.limited')
+            turn_away(socket, LIMITED_REPLY)
+            return
+
+        try:
+            connection = Connection(self, socket, address)
+            connection.run_hooks('pre_connection', connection)
+            connection.accept()
+            connection.run_hooks('post_connection', connection)
+        finally:
+            self.limiter.release(address[0])
 
     def load_config(self):
         self._config = load_config(self.options.config or 'vsmtpd.cfg', {
@@ -85,7 +205,27 @@ class Vsmtpd(object):
                 'size_limit': 0,
                 'helo_host': None,
                 'connection_limit': 100,
+                'pool_full_policy': 'shed',
+                'per_ip_connection_limit': 0,
+                'per_network_connection_limit': 0,
+                'share_connection_limits': False,
                 'spool_dir': '/var/spool/vsmtpd',
+                'memfd_spool_limit': 1048576,
+                'spool_memory_limit': 67108864,
+                'spool_memory_pressure': 0.5,
+                'spool_rollover': 262144,
+                'spool_digests': None,
+                'spool_store': False,
+                'greeting_timeout': 30,
+                'command_timeout': 30,
+                'data_block_timeout': 30,
+                'data_timeout': 600,
+                'overload_watermark': 0.8,
+                'overload_command_timeout': 5,
+                'reap_watermark': 0.95,
+                'dns_cache_size': 10000,
+                'dns_cache_ttl': 3600,
+                'dns_negative_ttl': 300,
                 'keyfile': None,
                 'certfile': None,
                 'cert_reqs': None,
@@ -116,17 +256,30 @@ class Vsmtpd(object):
                 exit(1)
 
             try:
-                if self._config.options(section):
-                    plugin = plugin_cls(ConfigWrapper(self._config, section))
+                config = ConfigWrapper(self._config, section)
+                # The guard options are consumed by HookGuard, so plugins
+                # that take no config can still be guarded.
+                options = [o for o in self._config.options(section)
+                           if not is_guard_option(o)]
+                if options:
+                    plugin = plugin_cls(config)
                 else:
                     plugin = plugin_cls()
                 plugin.plugin_name = plugin_name
+                guard = HookGuard.from_config(plugin_name, config)
             except Exception as e:
                 log.fatal("Failed to initialise plugin '%s'", plugin_name)
                 log.exception(e)
                 exit(1)
 
-            self.hook_manager.register_object(plugin)
+            self.hook_manager.register_object(plugin, guard)
+
+    def log_metrics(self, *args):
+        """
+        Log the current metrics of this process.
+        """
+        for name, value in sorted(metrics.snapshot().iteritems()):
+            log.info('metric %s = %s', name, value)
 
     def reload(self):
         """
@@ -142,6 +295,7 @@ class Vsmtpd(object):
         signal.signal(signal.SIGTERM, self.stop)
         signal.signal(signal.SIGHUP, self.reload)
         signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.log_metrics)
 
         workers = self.config.getint('workers')
         backlog = self.config.getint('backlog')
@@ -181,10 +335,30 @@ class Vsmtpd(object):
         Starts the vsmtpd server.
         """
 
-        self.server = StreamServer(listener, self.handle, backlog=backlog,
-            spawn=self.pool)
+        self.server = self.create_server(listener, backlog)
         self.server.serve_forever()
 
+    def create_server(self, listener, backlog=None):
+        """
+        Create the server that accepts connections, shedding them when the
+        connection pool is full if configured to.
+
+        :param listener: The address or socket to listen on
+        :type listener: tuple or socket
+        :keyword backlog: The listen backlog
+        :type backlog: int
+        """
+        policy = self.config.get('pool_full_policy')
+        if policy == 'shed':
+            server_cls = SheddingServer
+        elif policy == 'wait':
+            server_cls = StreamServer
+        else:
+            raise ValueError("Invalid pool_full_policy '%s'" % policy)
+
+        return server_cls(listener, self.handle, backlog=backlog,
+            spawn=self.pool)
+
     def _start_slave(self):
         """
         Starts a new slave worker process.
@@ -0,0 +1,138 @@
+#
+# vsmtpd/deferred.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+
+"""
+Work started by one hook for a result wanted by a later one, e.g. DNS
+blacklist lookups started when a client connects that are only needed
+once it gets as far as RCPT.
+
+The time between a deferred being started and its result being asked
+for is latency the client never sees, this is counted in the
+``deferred.hidden_ms`` metric with any time still spent waiting for the
+result counted in ``deferred.waited_ms``.
+"""
+
+import time
+import gevent
+import logging
+
+from vsmtpd.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+class Deferred(object):
+    """
+    A function running in the background whose result is collected later.
+
+    :param func: The function to call
+    :type func: callable
+    :param args: The positional arguments to call it with
+    :type args: tuple
+    :param kwargs: The keyword arguments to call it with
+    :type kwargs: dict
+    :keyword timeout: How long after starting to give up on the result
+    :type timeout: float
+    """
+
+    def __init__(self, func, args=(), kwargs=None, timeout=None):
+        self.timeout  = timeout
+        self.started  = time.time()
+        self.finished = None
+        self._waited  = False
+        self._aborted = False
+        self._job     = gevent.spawn(self._run, func, args, kwargs or {})
+        metrics.incr('deferred.started')
+
+    @property
+    def ready(self):
+        """
+        Whether the function has finished, one way or another.
+        """
+        return self._job.ready()
+
+    def _run(self, func, args, kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.finished = time.time()
+
+    def get(self, default=None):
+        """
+        Get the result, waiting for it if the function is still running.
+        If it doesn't finish before the timeout it is killed and the
+        default returned instead, as it is on every later call. An
+        exception raised by the function is raised again here.
+
+        :keyword default: The value to return if the function timed out
+        :type default: object
+        """
+        if self._aborted:
+            return default
+
+        requested = time.time()
+        if not self._job.ready():
+            remaining = None
+            if self.timeout is not None:
+                remaining = max(self.started + self.timeout - requested, 0)
+            self._job.join(remaining)
+
+        if not self._job.ready():
+            self._aborted = True
+            self._job.kill(block=False)
+            self._measure(requested, time.time())
+            metrics.incr('deferred.timed_out')
+            log.info('Gave up waiting for %r after %.1fs', self._job,
+                     time.time() - self.started)
+            return default
+
+        self._measure(requested, self.finished)
+        if not self._job.successful():
+            metrics.incr('deferred.failed')
+
+        # A greenlet that was killed returns the GreenletExit
+        value = self._job.get()
+        if isinstance(value, gevent.GreenletExit):
+            self._aborted = True
+            return default
+        return value
+
+    def cancel(self):
+        """
+        Stop the function if it is still running.
+        """
+        if not self._job.ready():
+            self._aborted = True
+            self._job.kill(block=False)
+            metrics.incr('deferred.cancelled')
+
+    def _measure(self, requested, finished):
+        # Only the first time the result is asked for says anything about
+        # how much of the work was hidden.
+        if self._waited:
+            return
+        self._waited = True
+        finished = finished or requested
+        metrics.incr('deferred.hidden_ms',
+                     int((min(finished, requested) - self.started) * 1000))
+        metrics.incr('deferred.waited_ms',
+                     int(max(finished - requested, 0) * 1000))
@@ -26,6 +26,9 @@ class Error(Exception):
 class TimeoutError(Error):
     pass
 
+class ReapedError(Error):
+    pass
+
 class HookNotFoundError(Error):
     pass
 
@@ -0,0 +1,284 @@
+#
+# vsmtpd/headers.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import re
+import logging
+
+from email import errors
+from email.message import Message as _Message, SEMISPACE, _formatparam
+
+log = logging.getLogger(__name__)
+
+#: The largest header block accepted, anything beyond it is the body
+MAX_HEADER_SIZE = 262144
+
+# The same as FeedParser's idea of a header field
+_field_re = re.compile(r'[\041-\071\073-\176]+:')
+
+def _dirties(method):
+    # Wrap a method that changes the headers to mark the message as dirty
+    # and throw away the index.
+    def wrapper(self, *args, **kwargs):
+        self.dirty = True
+        self._index = None
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+class Message(_Message):
+    """
+    The headers of a received message.
+
+    The header block of a received message is passed on as it was
+    received, only being regenerated from the parsed headers if they have
+    been changed, which is what ``dirty`` marks. Trace headers added with
+    prepend_header() don't count as a change, they are tracked in
+    ``prepended`` and simply written out before the original block.
+
+    Lookups by name go through an index of the headers, so that plugins
+    looking up and counting headers don't each have to scan them all.
+    """
+
+    def __init__(self):
+        _Message.__init__(self)
+        self.dirty = False
+        self.prepended = []
+        self._index = None
+
+    __setitem__ = _dirties(_Message.__setitem__)
+    __delitem__ = _dirties(_Message.__delitem__)
+    add_header = _dirties(_Message.add_header)
+    replace_header = _dirties(_Message.replace_header)
+    set_boundary = _dirties(_Message.set_boundary)
+
+    def __contains__(self, name):
+        return name.lower() in self.index()
+
+    def get(self, name, failobj=None):
+        positions = self.index().get(name.lower())
+        if not positions:
+            return failobj
+        return self._headers[positions[0]][1]
+
+    def get_all(self, name, failobj=None):
+        positions = self.index().get(name.lower())
+        if not positions:
+            return failobj
+        headers = self._headers
+        return [headers[i][1] for i in positions]
+
+    def header_count(self, name):
+        """
+        Returns the number of headers with the given name.
+
+        :param name: The name of the header, in any case
+        :type name: str
+        """
+        return len(self.index().get(name.lower(), ()))
+
+    def index(self):
+        """
+        Returns the index of the headers, which maps each lower cased name
+        to the positions of the headers with that name. It is built on
+        first use and again after the headers change.
+        """
+        if self._index is None:
+            index = {}
+            for pos, (name, value) in enumerate(self._headers):
+                index.setdefault(name.lower(), []).append(pos)
+            self._index = index
+        return self._index
+
+    def prepend_header(self, name, value):
+        """
+        Add a trace header, such as Received, to the top of the headers.
+
+        :param name: The name of the header
+        :type name: str
+        :param value: The value of the header
+        :type value: str
+        """
+        self._headers.insert(0, (name, value))
+        self.prepended.insert(0, (name, value))
+        self._index = None
+
+    def prepended_block(self):
+        """
+        Returns the trace headers added with prepend_header(), formatted
+        ready to go before the original header block.
+        """
+        return ''.join(['%s: %s\r\n' % (name,
+                        '\r\n'.join(value.splitlines()))
+                        for name, value in self.prepended])
+
+    @_dirties
+    def insert_header(self, _pos, _name, _value, **_params):
+        parts = []
+        for k, v in _params.items():
+            if v is None:
+                parts.append(k.replace('_', '-'))
+            else:
+                parts.append(_formatparam(k.replace('_', '-'), v))
+        if _value is not None:
+            parts.insert(0, _value)
+        self._headers.insert(_pos, (_name, SEMISPACE.join(parts)))
+
+class HeaderParser(object):
+    """
+    Parser for just the header block of a message.
+
+    Unlike FeedParser this knows nothing about MIME, it only splits the
+    header block up into fields, so it is cheap enough to run on every
+    message received. The body is left alone to be parsed later by
+    whoever needs it.
+
+    The whole message can be fed in, the parser works out where the
+    headers end as the data arrives: at the blank line, at the first line
+    that isn't part of a header like FeedParser, or once the header block
+    grows past max_size. Anything fed after that is ignored.
+
+    :keyword factory: The class of message to create
+    :type factory: class
+    :keyword max_size: The largest header block to accept
+    :type max_size: int
+    """
+
+    def __init__(self, factory=Message, max_size=MAX_HEADER_SIZE):
+        self._msg = factory()
+        self._max_size = max_size
+        self._partial = ''
+        self._lineno = 0
+        self._name = None
+        self._value = []
+
+        #: The number of bytes fed in so far
+        self.size = 0
+
+        #: The offset of the body, once the end of the headers is found
+        self.body_start = None
+
+        #: Data fed before the last chunk that turned out to be the start
+        #: of the body rather than part of the headers
+        self.carried = ''
+
+    def feed(self, data):
+        """
+        Add data from the message, returning True once the end of the
+        headers has been found.
+
+        :param data: The data to add
+        :type data: str
+        """
+        if self.body_start is not None:
+            return True
+
+        start = self.size - len(self._partial)
+        buf = self._partial + data if self._partial else data
+        self.size += len(data)
+
+        pos = 0
+        while True:
+            idx = buf.find('\n', pos)
+            if idx < 0:
+                break
+
+            if start + idx + 1 > self._max_size:
+                self._too_big()
+                return self._end(start + pos, start, buf, data)
+
+            end = self._line(buf[pos:idx + 1], start + pos)
+            if end is not None:
+                return self._end(end, start, buf, data)
+            pos = idx + 1
+
+        if self.size > self._max_size:
+            self._too_big()
+            return self._end(start + pos, start, buf, data)
+
+        self._partial = buf[pos:]
+        return False
+
+    def close(self):
+        """
+        Finish parsing and return the message.
+        """
+        if self.body_start is None and self._partial:
+            self._line(self._partial, self.size - len(self._partial))
+        self._partial = ''
+        self._add_field()
+        return self._msg
+
+    def _add_field(self):
+        if self._name is not None:
+            self._msg._headers.append((self._name,
+                ''.join(self._value).rstrip('\r\n')))
+            self._name = None
+
+    def _end(self, body_start, start, buf, data):
+        self.body_start = body_start
+        self.carried = buf[body_start - start:len(buf) - len(data)]
+        self._partial = ''
+        self._add_field()
+        return True
+
+    def _line(self, line, offset):
+        # Handle a single line of the headers, returning the offset of the
+        # body if the line ends them.
+        lineno = self._lineno
+        self._lineno += 1
+
+        if line in ('\r\n', '\n'):
+            return offset + len(line)
+
+        # Continuation of the previous field
+        if line[:1] in (' ', '\t'):
+            if self._name is None:
+                self._msg.defects.append(
+                    errors.FirstHeaderLineIsContinuationDefect(line))
+            else:
+                self._value.append(line)
+            return None
+
+        self._add_field()
+
+        if line.startswith('From '):
+            if lineno == 0:
+                self._msg.set_unixfrom(line.rstrip('\r\n'))
+            else:
+                self._msg.defects.append(
+                    errors.MisplacedEnvelopeHeaderDefect(line))
+            return None
+
+        match = _field_re.match(line)
+        if not match:
+            # Not a header so the body must have started without the
+            # blank line, as FeedParser would have it.
+            return offset
+
+        self._name = line[:match.end() - 1]
+        self._value = [line[match.end():].lstrip(' \t')]
+        return None
+
+    def _too_big(self):
+        log.info('header block larger than %d bytes, treating the rest as '
+                 'the body', self._max_size)
@@ -0,0 +1,172 @@
+#
+# vsmtpd/limits.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import socket
+import logging
+import multiprocessing
+
+log = logging.getLogger(__name__)
+
+def network(ip):
+    """
+    Returns the network a client address belongs to for the purpose of
+    limiting connections, the /24 for IPv4 and the /64 for IPv6.
+
+    :param ip: The client address
+    :type ip: str
+    """
+    if ':' not in ip:
+        return ip.rsplit('.', 1)[0] + '.0/24'
+
+    # IPv4 clients on a dual stack socket
+    if ip.startswith('::ffff:') and '.' in ip:
+        return network(ip[7:])
+
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip)
+    except (socket.error, ValueError):
+        return ip
+    return socket.inet_ntop(socket.AF_INET6, packed[:8] + '\0' * 8) + '/64'
+
+class LocalCounter(object):
+    """
+    Counts connections per key within a single process.
+    """
+
+    def __init__(self):
+        self._counts = {}
+
+    def __getitem__(self, key):
+        return self._counts.get(key, 0)
+
+    def incr(self, key):
+        count = self._counts[key] = self._counts.get(key, 0) + 1
+        return count
+
+    def decr(self, key):
+        count = self._counts.get(key, 0) - 1
+        if count > 0:
+            self._counts[key] = count
+        else:
+            self._counts.pop(key, None)
+
+class SharedCounter(object):
+    """
+    Counts connections per key in shared memory, so that the counts are
+    shared by all the workers forked after it is created.
+
+    Keys are hashed into a fixed number of slots, a collision means the
+    two keys share a count which can only make the limits stricter.
+
+    A worker that dies without releasing its connections leaves them
+    counted, which can lock an address out for good. Nothing respawns
+    workers at the moment, the master exits when one dies, but anything
+    that does will have to reset() the counts once the old workers are
+    gone.
+
+    :keyword slots: The number of slots to hash keys into
+    :type slots: int
+    """
+
+    def __init__(self, slots=65536):
+        self._slots = multiprocessing.RawArray('i', slots)
+        self._lock = multiprocessing.Lock()
+
+    def __getitem__(self, key):
+        return self._slots[hash(key) % len(self._slots)]
+
+    def incr(self, key):
+        slot = hash(key) % len(self._slots)
+        with self._lock:
+            count = self._slots[slot] = self._slots[slot] + 1
+        return count
+
+    def decr(self, key):
+        slot = hash(key) % len(self._slots)
+        with self._lock:
+            if self._slots[slot] > 0:
+                self._slots[slot] -= 1
+
+    def reset(self):
+        """
+        Forget all the counts.
+        """
+        with self._lock:
+            self._slots[:] = [0] * len(self._slots)
+
+class ConnectionLimiter(object):
+    """
+    Limits the number of concurrent connections from a single client
+    address and from a single network, a limit of 0 disables it.
+
+    :param per_ip: The connections allowed from each address
+    :type per_ip: int
+    :param per_network: The connections allowed from each network
+    :type per_network: int
+    :keyword shared: Share the counts between forked workers
+    :type shared: bool
+    :keyword slots: The number of slots to use when shared
+    :type slots: int
+    """
+
+    def __init__(self, per_ip, per_network, shared=False, slots=65536):
+        self.per_ip = per_ip
+        self.per_network = per_network
+        self._counter = SharedCounter(slots) if shared else LocalCounter()
+
+    def acquire(self, ip):
+        """
+        Count a new connection from the address, returns False if this
+        puts it over a limit, in which case it isn't counted.
+
+        :param ip: The client address
+        :type ip: str
+        """
+        counter = self._counter
+        if self.per_ip:
+            if counter.incr(ip) > self.per_ip:
+                counter.decr(ip)
+                log.info('Too many connections from %s', ip)
+                return False
+
+        if self.per_network:
+            net = network(ip)
+            if counter.incr(net) > self.per_network:
+                counter.decr(net)
+                if self.per_ip:
+                    counter.decr(ip)
+                log.info('Too many connections from %s', net)
+                return False
+
+        return True
+
+    def release(self, ip):
+        """
+        Stop counting a connection from the address.
+
+        :param ip: The client address
+        :type ip: str
+        """
+        if self.per_ip:
+            self._counter.decr(ip)
+        if self.per_network:
+            self._counter.decr(network(ip))
@@ -0,0 +1,75 @@
+#
+# vsmtpd/metrics.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Simple counters and gauges kept by each worker. They can be logged by
+sending the process a SIGUSR1.
+"""
+
+class Metrics(object):
+    """
+    A collection of named counters, which only ever go up, and gauges,
+    which are set to the current value of something.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def __getitem__(self, name):
+        return self._values.get(name, 0)
+
+    def incr(self, name, value=1):
+        """
+        Increment a counter.
+
+        :param name: The name of the counter
+        :type name: str
+        :keyword value: The amount to increment the counter by
+        :type value: int
+        """
+        self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name, value):
+        """
+        Set a gauge.
+
+        :param name: The name of the gauge
+        :type name: str
+        :param value: The current value
+        :type value: int or float
+        """
+        self._values[name] = value
+
+    def reset(self):
+        """
+        Reset all the metrics.
+        """
+        self._values.clear()
+
+    def snapshot(self):
+        """
+        Returns a copy of the current metrics.
+        """
+        return dict(self._values)
+
+#: The metrics of this worker
+metrics = Metrics()
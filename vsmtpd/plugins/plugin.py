@@ -46,6 +46,42 @@ class PluginBase(object):
     def declined(self):
         return None
 
+    def defer(self, connection, name, func, *args, **kwargs):
+        """
+        Start calling a function in the background, for a later hook to
+        get the result of with :meth:`deferred_result`. The work is tied
+        to the connection and killed if the client disconnects first.
+
+        :param connection: The connection the work is for
+        :type connection: :class:`vsmtpd.connection.Connection`
+        :param name: The name to store the result under
+        :type name: str
+        :param func: The function to call
+        :type func: callable
+        :keyword timeout: How long after starting to give up on the result
+        :type timeout: float
+        """
+        return connection.defer((self._defer_prefix, name), func, *args,
+                                **kwargs)
+
+    def deferred_result(self, connection, name, default=None):
+        """
+        Get the result of a function started with :meth:`defer`.
+
+        :param connection: The connection the work is for
+        :type connection: :class:`vsmtpd.connection.Connection`
+        :param name: The name the result is stored under
+        :type name: str
+        :keyword default: The value to return if the work wasn't started
+            or timed out
+        :type default: object
+        """
+        return connection.deferred_result((self._defer_prefix, name), default)
+
+    @property
+    def _defer_prefix(self):
+        return self.plugin_name or self.__module__
+
     def deny(self, message=None, disconnect=False):
         if disconnect:
             raise DenyDisconnectError(message)
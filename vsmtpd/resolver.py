@@ -0,0 +1,124 @@
+#
+# vsmtpd/resolver.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Reverse DNS lookups of connecting clients.
+
+Lookups are cached by IP address, including failed lookups, and can be
+started in the background when a connection is accepted so they are
+usually finished by the time anything wants the hostname.
+"""
+
+import gevent
+import logging
+
+from gevent import socket
+from vsmtpd.util import TTLCache
+
+log = logging.getLogger(__name__)
+
+#: The cache of IP address to hostname lookups
+cache = TTLCache(10000, 3600)
+
+#: How long to cache failed lookups for
+negative_ttl = 300
+
+_pending = {}
+_local_hosts = {}
+
+def configure(size=None, ttl=None, negative=None):
+    """
+    Configure the lookup cache.
+
+    :keyword size: The maximum number of addresses to cache
+    :type size: int
+    :keyword ttl: How long to cache successful lookups for in seconds
+    :type ttl: int
+    :keyword negative: How long to cache failed lookups for in seconds
+    :type negative: int
+    """
+    global negative_ttl
+    if size is not None:
+        cache.size = size
+    if ttl is not None:
+        cache.ttl = ttl
+    if negative is not None:
+        negative_ttl = negative
+
+def start_lookup(ip):
+    """
+    Start looking up the hostname of an IP address in the background.
+    Returns the greenlet performing the lookup, or None if the hostname
+    is already cached.
+
+    :param ip: The IP address to look up
+    :type ip: str
+    """
+    if ip in cache:
+        return None
+
+    job = _pending.get(ip)
+    if job is None:
+        job = _pending[ip] = gevent.spawn(_lookup, ip)
+    return job
+
+def get_host(ip, job=None):
+    """
+    Get the hostname of an IP address, waiting for the lookup if it is
+    still in progress. If the lookup fails the IP address is returned.
+
+    :param ip: The IP address to look up
+    :type ip: str
+    :keyword job: A lookup returned by :func:`start_lookup`
+    :type job: Greenlet
+    """
+    host = cache.get(ip)
+    if host is not None:
+        return host
+
+    if job is None:
+        job = start_lookup(ip)
+        if job is None:
+            return cache.get(ip, ip)
+
+    return job.get()
+
+def local_host(ip):
+    """
+    Get the hostname of one of our listening addresses, these are only
+    ever looked up once.
+
+    :param ip: The local IP address
+    :type ip: str
+    """
+    host = _local_hosts.get(ip)
+    if host is None:
+        host = _local_hosts[ip] = socket.getfqdn(ip)
+    return host
+
+def _lookup(ip):
+    try:
+        host = socket.getfqdn(ip)
+        cache.set(ip, host, negative_ttl if host == ip else None)
+        return host
+    finally:
+        _pending.pop(ip, None)
@@ -0,0 +1,670 @@
+#
+# vsmtpd/spool.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+import mmap
+import errno
+import hashlib
+import logging
+import tempfile
+
+from binascii import hexlify
+from bisect import bisect_right
+from email.parser import Parser
+from vsmtpd.headers import HeaderParser, Message
+from vsmtpd.metrics import metrics
+from vsmtpd.util import O_CLOEXEC, O_TMPFILE, fallocate, link_fd, memfd_create
+
+log = logging.getLogger(__name__)
+
+#: The size small writes are gathered into before being kept as a chunk
+CHUNKSIZE = 65536
+
+#: The buffer size used when writing a spool to disk
+WRITE_BUFSIZE = 1048576
+
+#: The most disk space allocated up front for a message, whatever size
+#: the client says it is
+MAX_PREALLOCATE = 33554432
+
+class ChunkedBuffer(object):
+    """
+    In-memory file-like object that keeps what is written to it as a list
+    of chunks rather than one contiguous string. Growing it never copies
+    what is already there and it can be handed over to a file a chunk at
+    a time.
+
+    Writes always go to the end of the buffer, as with a file opened for
+    appending.
+
+    :keyword chunksize: The size to gather small writes up to
+    :type chunksize: int
+    """
+
+    def __init__(self, chunksize=CHUNKSIZE):
+        self.closed = False
+        self._chunksize = chunksize
+        self._chunks = []
+        self._offsets = []
+        self._pending = []
+        self._pending_len = 0
+        self._size = 0
+        self._pos = 0
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def __len__(self):
+        return self._size
+
+    def close(self):
+        self.closed = True
+        self._chunks = []
+        self._offsets = []
+        self._pending = []
+        self._pending_len = self._size = self._pos = 0
+
+    def compact(self):
+        """
+        Join the chunks into one, returning the whole buffer as a string.
+        Once compacted, later calls don't need to copy anything unless
+        more has been written.
+        """
+        self._seal()
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+            self._offsets = [0]
+        return self._chunks[0] if self._chunks else ''
+
+    def drain(self):
+        """
+        Yields the chunks of the buffer, dropping each one from the buffer
+        as it goes so only one chunk at a time is held on to elsewhere.
+        """
+        self._seal()
+        chunks = self._chunks
+        while chunks:
+            yield chunks.pop(0)
+            self._offsets.pop(0)
+        self._size = self._pos = 0
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        self._seal()
+        return ''.join(self._chunks)
+
+    def read(self, size=-1):
+        self._seal()
+        end = self._size if size < 0 else min(self._pos + size, self._size)
+        return self._read(end)
+
+    def readline(self, size=-1):
+        self._seal()
+        end = self._size if size < 0 else min(self._pos + size, self._size)
+        idx = self._index(self._pos)
+        while idx < len(self._chunks):
+            start = self._offsets[idx]
+            if start >= end:
+                break
+            nl = self._chunks[idx].find('\n', max(self._pos - start, 0))
+            if nl >= 0:
+                end = min(start + nl + 1, end)
+                break
+            idx += 1
+        return self._read(end)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size
+        self._pos = max(offset, 0)
+
+    def tell(self):
+        return self._pos
+
+    def write(self, data):
+        if not data:
+            return
+        self._pending.append(data)
+        self._pending_len += len(data)
+        self._size += len(data)
+        self._pos = self._size
+        if self._pending_len >= self._chunksize:
+            self._seal()
+
+    def _index(self, pos):
+        return max(bisect_right(self._offsets, pos) - 1, 0)
+
+    def _read(self, end):
+        pos = self._pos
+        if pos >= end:
+            return ''
+
+        out = []
+        idx = self._index(pos)
+        while pos < end:
+            start = self._offsets[idx]
+            piece = self._chunks[idx][pos - start:end - start]
+            out.append(piece)
+            pos += len(piece)
+            idx += 1
+
+        self._pos = pos
+        return ''.join(out)
+
+    def _seal(self):
+        # Turn the small writes gathered so far into a chunk
+        if not self._pending:
+            return
+        self._offsets.append(self._size - self._pending_len)
+        self._chunks.append(''.join(self._pending))
+        self._pending = []
+        self._pending_len = 0
+
+def parse_digests(value):
+    """
+    Parse a comma separated list of digests to compute for each message,
+    such as "sha256, md5, body:sha256". Those prefixed with "body:" only
+    cover the body of the message.
+
+    :param value: The list of digests
+    :type value: str
+    """
+    digests = []
+    for name in (value or '').split(','):
+        name = name.strip().lower()
+        if not name:
+            continue
+
+        algorithm = name[5:] if name.startswith('body:') else name
+        try:
+            hashlib.new(algorithm)
+        except ValueError:
+            raise ValueError("Unknown digest '%s'" % name)
+        digests.append(name)
+    return tuple(digests)
+
+class BodyView(object):
+    """
+    A read-only view of a message that can be sliced without copying it.
+    The data is either a memoryview or an mmap of the spool file, for
+    which `buffer` gives copy-free slices.
+
+    :param data: The whole message
+    :type data: memoryview or mmap
+    :param body_start: The offset of the body within the message
+    :type body_start: int
+    """
+
+    @property
+    def headers(self):
+        """
+        The header block of the message, including the blank line.
+        """
+        return self._slice(0, self.body_start)
+
+    @property
+    def body(self):
+        """
+        The body of the message.
+        """
+        return self._slice(self.body_start, len(self.data))
+
+    def __init__(self, data, body_start):
+        self.data = data
+        self.body_start = body_start
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        """
+        Release the view, it can't be used afterwards.
+        """
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = memoryview('')
+        self.body_start = 0
+
+    def _slice(self, start, end):
+        if isinstance(self.data, memoryview):
+            return self.data[start:end]
+        return buffer(self.data, start, end - start)
+
+class MemoryBudget(object):
+    """
+    Accounts for the memory used by all the spools in a worker, so that
+    whether a message is kept in memory depends on how busy the worker is
+    rather than on the size of each message alone.
+
+    Spools can use up to ``limit`` bytes between them. Once more than
+    ``pressure`` of that is in use only spools holding no more than
+    ``rollover`` bytes are allowed any more, larger ones are moved to
+    disk.
+
+    :param limit: The memory all the spools can use
+    :type limit: int
+    :keyword pressure: The fraction of the limit after which only small
+        messages are kept in memory
+    :type pressure: float
+    :keyword rollover: The most a spool can hold once under pressure
+    :type rollover: int
+    """
+
+    @property
+    def used(self):
+        return self._used
+
+    def __init__(self, limit, pressure=0.5, rollover=262144):
+        self.limit = limit
+        self.pressure = pressure
+        self.rollover = rollover
+        self._used = 0
+
+    def reserve(self, size, held=0):
+        """
+        Reserve memory for a spool, returns False if there isn't enough
+        and the spool should be moved to disk instead.
+
+        :param size: The amount of memory wanted
+        :type size: int
+        :keyword held: The amount of memory the spool already has
+        :type held: int
+        """
+        used = self._used + size
+        if used > self.limit:
+            return False
+        if used > self.limit * self.pressure and held + size > self.rollover:
+            return False
+
+        self._used = used
+        metrics.set('spool.memory_used', used)
+        return True
+
+    def release(self, size):
+        """
+        Give back memory reserved by a spool.
+
+        :param size: The amount of memory to give back
+        :type size: int
+        """
+        self._used = max(self._used - size, 0)
+        metrics.set('spool.memory_used', self._used)
+
+class Spool(object):
+    """
+    Thin wrapper around either a file-object or a ChunkedBuffer. Allows
+    use of the body attribute without losing functionality by avoiding
+    the class level methods of the transaction.
+
+    Messages start off in memory. Those that are no larger than
+    ``memfd_limit`` are moved to a memfd when they outgrow the buffer or a
+    file is asked for with link(), which gives external programs a path to
+    read them from without them ever being written to disk.
+
+    Anything larger is spooled to a file in the spool directory. Where
+    possible this is created with O_TMPFILE so that it doesn't get a name
+    unless one is asked for with link().
+
+    :keyword directory: The directory to spool to, defaults to the
+        system's temporary directory
+    :type directory: str
+    :keyword size: The size the client said the message will be, used to
+        allocate the disk space for it up front
+    :type size: int
+    :keyword memfd_limit: The largest message to keep in a memfd, 0
+        disables them
+    :type memfd_limit: int
+    :keyword budget: The budget to reserve memory from, without one
+        messages are moved out of memory once they reach 256kb
+    :type budget: MemoryBudget
+    :keyword digests: The digests to compute as the message is written,
+        see parse_digests()
+    :type digests: tuple
+    """
+
+    @property
+    def body_start(self):
+        return self._body_start
+
+    @property
+    def digests(self):
+        """
+        The hex digests of what has been written so far, keyed by the
+        names they were asked for with.
+        """
+        return dict([(name, h.hexdigest()) for name, h in self._digests])
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @property
+    def backend(self):
+        """
+        Where the message is being kept: 'memory', 'memfd' or 'disk'.
+        """
+        return self._backend
+
+    @property
+    def name(self):
+        if self._backend == 'memfd':
+            # This has to name our pid rather than self, it's going to be
+            # used by other processes.
+            return '/proc/%d/fd/%d' % (os.getpid(), self._fp.fileno())
+        return self._filename
+
+    @property
+    def on_disk(self):
+        return self._backend == 'disk'
+
+    def __init__(self, directory=None, size=None, memfd_limit=0,
+                 budget=None, digests=()):
+        self._backend  = 'memory'
+        self._body_start = 0
+        self._budget   = budget
+
+        # The digests of the whole message and those of just the body
+        self._digests  = []
+        self._message_hashes = []
+        self._body_hashes = []
+        for name in digests:
+            if name.startswith('body:'):
+                h = hashlib.new(name[5:])
+                self._body_hashes.append(h)
+            else:
+                h = hashlib.new(name)
+                self._message_hashes.append(h)
+            self._digests.append((name, h))
+        self._reserved = 0
+        self._directory = directory or tempfile.gettempdir()
+        self._filename = None
+        self._memfd_limit = memfd_limit
+        self._size     = size
+        self._fp       = ChunkedBuffer()
+        self._headers  = None
+        self._in_headers = True
+        self._message  = None
+        self._parser   = HeaderParser(Message)
+        self._rollover = 262144 # 256kb
+
+    def __getattr__(self, key):
+        return getattr(self._fp, key)
+
+    def __iter__(self):
+        return iter(self._fp)
+
+    def close(self):
+        """
+        Close the spool, removing the file it was written to if there is
+        one.
+        """
+        self._fp.close()
+        self._release()
+        if self._filename:
+            try:
+                os.unlink(self._filename)
+            except OSError as e:
+                log.warning('unable to remove spool file %s: %s',
+                            self._filename, e)
+            self._filename = None
+
+    def end_headers(self):
+        """
+        Close off the parser and return the headers. This is called
+        automatically when the blank line ending the headers is written.
+        """
+        if not self._in_headers:
+            return self._headers
+
+        self._in_headers = False
+        self._body_start = self._parser.body_start
+        if self._body_start is None:
+            self._body_start = self._fp.tell()
+        self._headers = self._parser.close()
+        self._headers.index()
+        log.debug('headers marked as closed at %d chars', self._body_start)
+        return self._headers
+
+    def flush(self):
+        """
+        Flushes the data held in memory to a temporary file on disk.
+        """
+        # Check to see if the data has been flushed already
+        if self._backend == 'disk':
+            return
+
+        log.debug('flushing spool to disk')
+        newfp = self._create_file()
+
+        # Allocate the space for the whole message now, rather than as
+        # it is written, to keep the file in one piece on disk. The size
+        # comes from the client so it can't be trusted too far.
+        size = min(self._size or 0, MAX_PREALLOCATE)
+        if size > self._fp.tell():
+            try:
+                fallocate(newfp.fileno(), 0, size)
+            except OSError as e:
+                log.warning('unable to allocate spool space: %s', e)
+
+        self._move(newfp, 'disk')
+        self._release()
+
+    def header_block(self):
+        """
+        Returns the header block of the message to pass on, including the
+        blank line ending it. This is the block as it was received with
+        any trace headers in front of it, unless the headers have been
+        changed in which case it is regenerated from them.
+        """
+        headers = self.end_headers()
+        if headers.dirty:
+            return '\r\n'.join(headers.as_string().splitlines()) + '\r\n'
+
+        pos = self._fp.tell()
+        self._fp.seek(0)
+        try:
+            raw = self._fp.read(self._body_start)
+        finally:
+            self._fp.seek(pos)
+        return headers.prepended_block() + raw
+
+    def link(self):
+        """
+        Returns the name of a file the message can be read from, moving
+        it out of memory and giving the file a name first if needed.
+        """
+        if self._backend == 'memory':
+            self._rollover_to(self._fp.tell())
+
+        self._fp.flush()
+        if self._backend == 'memfd' or self._filename:
+            return self.name
+
+        filename = os.path.join(self._directory, hexlify(os.urandom(8)))
+        link_fd(self._fp.fileno(), filename)
+        self._filename = filename
+
+        log.debug('flushed to disk with name %s', self._filename)
+        return self._filename
+
+    def parse(self):
+        """
+        Parse the whole message, including the MIME structure of the
+        body. This is only done when asked for and the result is kept
+        until more data is written.
+        """
+        if self._message is None:
+            pos = self._fp.tell()
+            self._fp.seek(0)
+            try:
+                self._message = Parser(Message).parse(self._fp)
+            finally:
+                self._fp.seek(pos)
+        return self._message
+
+    def view(self):
+        """
+        Returns the message as received so far without copying it: a
+        memoryview while it's in memory, otherwise an mmap of the file.
+        """
+        if self._backend == 'memory':
+            return memoryview(self._fp.compact())
+
+        self._fp.flush()
+        size = os.fstat(self._fp.fileno()).st_size
+        if not size:
+            return memoryview('')
+        return mmap.mmap(self._fp.fileno(), size, access=mmap.ACCESS_READ)
+
+    def write(self, data):
+        """
+        Write data to the end of the email.
+
+        :param data: The data to add to the end of the email
+        :type data: str
+        """
+        self._message = None
+
+        if self._in_headers:
+            parser = self._parser
+            fed = parser.size
+            if not parser.feed(data):
+                self._write(data)
+                return
+
+            end = parser.body_start - fed
+            if end > 0:
+                self._write(data[:end])
+                data = data[end:]
+            self.end_headers()
+
+            # The body may have started in data already written
+            for h in self._body_hashes:
+                h.update(parser.carried)
+            if not data:
+                return
+
+        self._write(data)
+
+    def _create_memfd(self):
+        try:
+            fd = memfd_create('vsmtpd-spool')
+        except OSError as e:
+            log.debug('unable to create memfd: %s', e)
+            return None
+        return os.fdopen(fd, 'w+b', WRITE_BUFSIZE)
+
+    def _create_file(self):
+        if O_TMPFILE is not None:
+            try:
+                fd = os.open(self._directory,
+                             O_TMPFILE | O_CLOEXEC | os.O_RDWR, 0600)
+            except OSError as e:
+                # The kernel or filesystem doesn't support O_TMPFILE
+                if e.errno not in (errno.EOPNOTSUPP, errno.EISDIR,
+                                   errno.EINVAL):
+                    raise
+            else:
+                return os.fdopen(fd, 'w+b', WRITE_BUFSIZE)
+
+        fd, self._filename = tempfile.mkstemp(dir=self._directory,
+                                              prefix='')
+        log.debug('flushed to disk with name %s', self._filename)
+        return os.fdopen(fd, 'w+b', WRITE_BUFSIZE)
+
+    def _fits_memfd(self, size):
+        return bool(self._memfd_limit and
+                    max(size, self._size or 0) <= self._memfd_limit)
+
+    def _move(self, newfp, backend):
+        # Hand the data over a chunk at a time so it's never all copied
+        # at once.
+        fp = self._fp
+        pos = fp.tell()
+        if self._backend == 'memory':
+            chunks = fp.drain()
+        else:
+            fp.seek(0)
+            chunks = iter(lambda: fp.read(WRITE_BUFSIZE), '')
+
+        for chunk in chunks:
+            newfp.write(chunk)
+        newfp.seek(pos, 0)
+        fp.close()
+
+        self._fp = newfp
+        self._backend = backend
+
+    def _rollover_to(self, size):
+        # Move the data out of memory, into a memfd if it'll fit otherwise
+        # onto disk.
+        if self._fits_memfd(size):
+            newfp = self._create_memfd()
+            if newfp is not None:
+                log.debug('moving spool to a memfd')
+                self._move(newfp, 'memfd')
+                return
+        self.flush()
+
+    def _write(self, data):
+        datalen = len(data)
+        log.debug('writing %d bytes of data', datalen)
+
+        size = self._fp.tell() + datalen
+        if self._backend == 'memory':
+            if self._over_budget(datalen):
+                self.flush()
+            elif self._budget is None and size > self._rollover:
+                self._rollover_to(size)
+        elif self._backend == 'memfd':
+            if self._over_budget(datalen) or not self._fits_memfd(size):
+                self.flush()
+
+        self._fp.write(data)
+
+        for h in self._message_hashes:
+            h.update(data)
+        if not self._in_headers:
+            for h in self._body_hashes:
+                h.update(data)
+
+    def _over_budget(self, size):
+        # Reserve memory for more data, returns True if there isn't enough
+        # and the spool has to go to disk instead.
+        if self._budget is None:
+            return False
+        if self._budget.reserve(size, self._reserved):
+            self._reserved += size
+            return False
+
+        log.debug('spool memory budget exhausted, spilling to disk')
+        metrics.incr('spool.spills')
+        return True
+
+    def _release(self):
+        if self._reserved:
+            self._budget.release(self._reserved)
+            self._reserved = 0
@@ -0,0 +1,204 @@
+#
+# vsmtpd/store.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+import errno
+import hashlib
+import logging
+import tempfile
+
+from binascii import hexlify
+from vsmtpd.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+class Blob(object):
+    """
+    A reference to a body held in a BlobStore. The body can be read from
+    ``path`` until the reference is released.
+
+    :param store: The store the body is in
+    :type store: BlobStore
+    :param digest: The digest of the body
+    :type digest: str
+    :param path: The file holding this reference
+    :type path: str
+    """
+
+    @property
+    def refcount(self):
+        """
+        The number of references to the body, including any links made
+        with link().
+        """
+        return os.stat(self.path).st_nlink - 1
+
+    def __init__(self, store, digest, path):
+        self.store = store
+        self.digest = digest
+        self.path = path
+
+    def link(self, path):
+        """
+        Take another reference to the body by linking it to path, for
+        keeping it after the transaction is over. The body is kept until
+        path is removed.
+
+        :param path: The name to link the body to
+        :type path: str
+        """
+        os.link(self.path, path)
+
+    def release(self):
+        """
+        Release the reference, the body is removed from the store once
+        there are none left.
+        """
+        if self.path:
+            self.store.release(self)
+            self.path = None
+
+class BlobStore(object):
+    """
+    A content-addressed store of message bodies, so that identical bodies
+    received over separate connections share a single file.
+
+    Bodies are kept in ``objects`` under the directory, named by their
+    digest. Each reference to a body is a hard link to it in ``refs``,
+    which makes the link count of the file its reference count. The body
+    is removed from ``objects`` once the last reference is released,
+    although anything still linked to it keeps it on disk.
+
+    :param directory: The directory to keep the store in
+    :type directory: str
+    :keyword algorithm: The hashlib algorithm bodies are keyed by
+    :type algorithm: str
+    """
+
+    def __init__(self, directory, algorithm='sha256'):
+        self.directory = directory
+        self.algorithm = algorithm
+        self._objects = os.path.join(directory, 'objects')
+        self._refs = os.path.join(directory, 'refs')
+        _makedirs(self._objects)
+        _makedirs(self._refs)
+
+    def path(self, digest):
+        """
+        Returns the path of the body with the given digest.
+
+        :param digest: The hex digest of the body
+        :type digest: str
+        """
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def ref(self, digest):
+        """
+        Take a new reference to a body already in the store.
+
+        :param digest: The hex digest of the body
+        :type digest: str
+        """
+        path = os.path.join(self._refs, hexlify(os.urandom(8)))
+        os.link(self.path(digest), path)
+        return Blob(self, digest, path)
+
+    def release(self, blob):
+        """
+        Release a reference to a body, removing the body once there are
+        no more.
+
+        :param blob: The reference to release
+        :type blob: Blob
+        """
+        os.unlink(blob.path)
+
+        # Another worker could take a reference between checking and
+        # removing, which only costs it sharing the body with the next
+        # message as its reference is a link to the same file.
+        path = self.path(blob.digest)
+        try:
+            if os.stat(path).st_nlink == 1:
+                os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def store(self, data, digest=None):
+        """
+        Store a body, returning a reference to it. If an identical body is
+        already in the store that is used and data isn't written out.
+
+        :param data: The body
+        :type data: str or buffer
+        :keyword digest: The hex digest of the body, if already known
+        :type digest: str
+        """
+        if digest is None:
+            digest = hashlib.new(self.algorithm, data).hexdigest()
+
+        written = False
+        while True:
+            try:
+                blob = self.ref(digest)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                if not written:
+                    log.debug('body %s already stored', digest)
+                    metrics.incr('store.deduplicated')
+                return blob
+
+            written = self._write(self.path(digest), data)
+
+    def _write(self, path, data):
+        # Returns False if the body turned out to be stored already
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+
+            # If another worker stored the same body first this fails, and
+            # theirs is used instead.
+            try:
+                os.link(tmp, path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                return False
+        finally:
+            os.unlink(tmp)
+
+        log.debug('stored body %s', os.path.basename(path))
+        metrics.incr('store.objects')
+        return True
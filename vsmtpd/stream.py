@@ -0,0 +1,249 @@
+#
+# vsmtpd/stream.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import logging
+
+log = logging.getLogger(__name__)
+
+BUFSIZE = 65536
+
+def format_reply(code, message=''):
+    """
+    Build a complete, possibly multi-line, SMTP reply ready to be written
+    to the client.
+
+    :param code: The reply code
+    :type code: int
+    :keyword message: The reply text, one line per reply line
+    :type message: str
+    """
+    lines = (message or '').splitlines() or ['']
+    last = lines.pop()
+    reply = ['%3.3d-%s\r\n' % (code, line) for line in lines]
+    reply.append('%3.3d %s\r\n' % (code, last))
+    return ''.join(reply)
+
+class DataDecoder(object):
+    """
+    Incremental decoder for the dot-stuffed message sent after DATA.
+
+    Blocks are fed in as they are read from the client and the decoded
+    message data is returned. Only lines starting with a dot need any
+    attention so the blocks are scanned for those rather than being split
+    up into lines, with just enough state carried between blocks to cope
+    with a line being split across them.
+    """
+
+    def __init__(self):
+        #: Set once the terminating ".\r\n" line has been seen
+        self.done = False
+
+        #: Set if a ".\n" line (a bare LF) has been seen
+        self.bare_lf = False
+
+        #: Data following the terminating line, e.g. pipelined commands
+        self.rest = ''
+
+        self._bol = True
+        self._pending = ''
+
+    def feed(self, data):
+        """
+        Decode a block of data from the client.
+
+        :param data: The data as received from the client
+        :type data: str
+        """
+        if self._pending:
+            data = self._pending + data
+            self._pending = ''
+
+        out = []
+        start = 0
+
+        if self._bol and data[:1] == '.':
+            idx = 0
+        else:
+            idx = data.find('\n.')
+            if idx >= 0:
+                idx += 1
+
+        # idx is always the position of a dot at the start of a line
+        while idx >= 0:
+            after = data[idx + 1:idx + 3]
+
+            if after == '\r\n':
+                out.append(data[start:idx])
+                self.done = True
+                self.rest = data[idx + 3:]
+                return ''.join(out)
+
+            if after[:1] == '\n':
+                self.bare_lf = True
+                return ''
+
+            if after in ('', '\r'):
+                # Can't tell what this line is yet, hold on to it until
+                # there's more data.
+                out.append(data[start:idx])
+                self._pending = data[idx:]
+                self._bol = True
+                return ''.join(out)
+
+            # Any other line starting with a dot has it removed (RFC 5321
+            # section 4.5.2), not just the ".." of a stuffed dot.
+            out.append(data[start:idx])
+            start = idx + 1
+
+            idx = data.find('\n.', idx + 1)
+            if idx >= 0:
+                idx += 1
+
+        out.append(data[start:])
+        if data:
+            self._bol = data[-1] == '\n'
+        return ''.join(out)
+
+class Stream(object):
+    """
+    Buffered reader and writer around the client socket.
+
+    Replies written to the stream are held in memory and only sent to the
+    client when the stream has to block waiting for more input, which is
+    what allows ESMTP PIPELINING to answer a whole batch of commands with
+    a single write.
+
+    :param sock: The client socket
+    :type sock: socket
+    :keyword bufsize: The amount of data to read from the socket at once
+    :type bufsize: int
+    """
+
+    @property
+    def pending(self):
+        """
+        The number of bytes received from the client that haven't been
+        consumed yet.
+        """
+        return len(self._rbuf) - self._rpos
+
+    def __init__(self, sock, bufsize=BUFSIZE):
+        self._sock    = sock
+        self._bufsize = bufsize
+        self._rbuf    = ''
+        self._rpos    = 0
+        self._wbuf    = []
+        self._wlen    = 0
+
+    def readline(self):
+        """
+        Read a single line from the client, including the line ending.
+        Returns an empty string if the client has disconnected.
+        """
+        rbuf = self._rbuf
+        idx = rbuf.find('\n', self._rpos)
+
+        while idx < 0:
+            data = self._recv(self._bufsize)
+            if not data:
+                # Return whatever partial line is left, much like a
+                # file object would.
+                line = self._rbuf[self._rpos:]
+                self._rbuf = ''
+                self._rpos = 0
+                return line
+
+            # Only search the newly received data for the line ending
+            start = len(self._rbuf) - self._rpos
+            rbuf = self._rbuf = self._rbuf[self._rpos:] + data
+            self._rpos = 0
+            idx = rbuf.find('\n', start)
+
+        line = rbuf[self._rpos:idx + 1]
+        self._rpos = idx + 1
+        if self._rpos == len(rbuf):
+            self._rbuf = ''
+            self._rpos = 0
+        return line
+
+    def read(self, size):
+        """
+        Read up to size bytes from the client, returning any data that
+        is already buffered before reading from the socket. Returns an
+        empty string if the client has disconnected.
+
+        :param size: The maximum number of bytes to return
+        :type size: int
+        """
+        if self._rpos < len(self._rbuf):
+            end = self._rpos + size
+            data = self._rbuf[self._rpos:end]
+            if end >= len(self._rbuf):
+                self._rbuf = ''
+                self._rpos = 0
+            else:
+                self._rpos = end
+            return data
+
+        return self._recv(min(size, self._bufsize))
+
+    def unread(self, data):
+        """
+        Push data back to be returned by the next read.
+
+        :param data: The data to push back
+        :type data: str
+        """
+        if data:
+            self._rbuf = data + self._rbuf[self._rpos:]
+            self._rpos = 0
+
+    def write(self, data):
+        """
+        Queue data to be sent to the client, it will be sent the next
+        time the stream is flushed.
+
+        :param data: The data to send
+        :type data: str
+        """
+        self._wbuf.append(data)
+        self._wlen += len(data)
+        if self._wlen >= self._bufsize:
+            self.flush()
+
+    def flush(self):
+        """
+        Send any queued data to the client in a single write.
+        """
+        if not self._wbuf:
+            return
+        data = ''.join(self._wbuf)
+        del self._wbuf[:]
+        self._wlen = 0
+        self._sock.sendall(data)
+
+    def _recv(self, size):
+        # We're about to block waiting on the client so anything we've
+        # queued up has to go out first, otherwise a pipelining client
+        # will be left waiting on our replies.
+        self.flush()
+        return self._sock.recv(size)
@@ -0,0 +1,46 @@
+#
+# vsmtpd/tests/plugins/test_check_loop.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from vsmtpd.transaction import Transaction
+from vsmtpd.tests.common import PluginTestCase
+from vsmtpd.verdict import DENY
+
+class CheckLoopTestCase(PluginTestCase):
+
+    plugin_name = 'check_loop'
+
+    def transaction(self, hops):
+        transaction = Transaction(None)
+        for i in xrange(hops):
+            transaction.body.write('Received: from hop%d\r\n' % i)
+        transaction.body.write('Delivered-To: joe@example.com\r\n\r\n')
+        transaction.end_headers()
+        return transaction
+
+    def test_under_limit(self):
+        plugin = self.plugin()
+        self.assertEqual(plugin.data_post(self.transaction(99)), None)
+
+    def test_too_many_hops(self):
+        plugin = self.plugin()
+        self.assertEqual(plugin.data_post(self.transaction(100)),
+                         DENY("Too many hops (#5.4.6)"))
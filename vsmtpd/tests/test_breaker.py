@@ -0,0 +1,171 @@
+#
+# vsmtpd/tests/test_breaker.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+
+import time
+import gevent
+import ConfigParser
+
+from vsmtpd.breaker import CircuitBreaker, HookGuard
+from vsmtpd.config import ConfigWrapper
+from vsmtpd.error import DenyError
+from vsmtpd.hooks import hook, HookManager
+from vsmtpd.metrics import metrics
+from vsmtpd.tests.common import TestCase
+from vsmtpd.verdict import DENY, DENYSOFT
+
+class SlowPlugin(object):
+
+    def __init__(self):
+        self.delay = 0
+        self.error = None
+        self.calls = 0
+
+    @hook
+    def rcpt(self, transaction, rcpt):
+        self.calls += 1
+        gevent.sleep(self.delay)
+        if self.error:
+            raise self.error
+
+def section(**options):
+    config = ConfigParser.SafeConfigParser()
+    config.add_section('plugin:slow')
+    for key, value in options.iteritems():
+        config.set('plugin:slow', key, str(value))
+    return ConfigWrapper(config, 'plugin:slow')
+
+class CircuitBreakerTestCase(TestCase):
+
+    def test_opens(self):
+        breaker = CircuitBreaker('slow', threshold=2, retry_after=60)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertTrue(breaker.open)
+        self.assertFalse(breaker.allow())
+
+    def test_success_resets(self):
+        breaker = CircuitBreaker('slow', threshold=2)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertFalse(breaker.open)
+
+    def test_probe(self):
+        breaker = CircuitBreaker('slow', threshold=1, retry_after=60)
+        breaker.failure()
+        breaker.opened = time.time() - 61
+
+        # Only a single call is let through to probe the plugin
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        # A failed probe opens it again
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+        breaker.opened = time.time() - 61
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertFalse(breaker.open)
+        self.assertTrue(breaker.allow())
+
+class HookGuardTestCase(TestCase):
+
+    def setUp(self):
+        self.manager = HookManager()
+        self.plugin = SlowPlugin()
+
+    def register(self, **options):
+        guard = HookGuard.from_config('slow', section(**options))
+        self.manager.register_object(self.plugin, guard)
+        return guard
+
+    def test_unconfigured(self):
+        self.assertEqual(HookGuard.from_config('slow', section()), None)
+
+        # A plugin's own options aren't mistaken for the guard's
+        self.assertEqual(HookGuard.from_config('slow',
+            section(timeout=5, retry_after=10)), None)
+
+    def test_invalid_on_failure(self):
+        self.assertRaises(ValueError, HookGuard.from_config, 'slow',
+                          section(hook_on_failure='maybe'))
+
+    def test_hook_timeout(self):
+        guard = self.register(hook_timeout=5, rcpt_hook_timeout=0.05,
+                              hook_on_failure='denysoft')
+        self.assertEqual(guard.timeouts, {'rcpt': 0.05})
+
+        timed_out = metrics['plugins.timed_out']
+        self.plugin.delay = 1
+        start = time.time()
+        result = self.manager.dispatch_hook('rcpt', None, 'joe')
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(result, DENYSOFT('Service temporarily unavailable'))
+        self.assertEqual(metrics['plugins.timed_out'], timed_out + 1)
+
+    def test_skipped_when_open(self):
+        guard = self.register(hook_failure_threshold=2,
+                              hook_on_failure='deny')
+        self.plugin.error = ValueError('broken')
+        for i in xrange(2):
+            self.assertRaises(ValueError, self.manager.dispatch_hook,
+                              'rcpt', None, 'joe')
+        self.assertTrue(guard.breaker.open)
+
+        result = self.manager.dispatch_hook('rcpt', None, 'joe')
+        self.assertEqual(result.code, DENY.code)
+        self.assertEqual(self.plugin.calls, 2)
+
+    def test_verdicts_are_not_failures(self):
+        guard = self.register(hook_failure_threshold=1)
+        self.plugin.error = DenyError('No such user')
+        self.assertEqual(self.manager.dispatch_hook('rcpt', None, 'joe'),
+                         DENY('No such user'))
+        self.assertFalse(guard.breaker.open)
+
+    def test_killed_probe(self):
+        guard = self.register(hook_failure_threshold=1, hook_retry_after=0)
+        self.plugin.error = ValueError('broken')
+        self.assertRaises(ValueError, self.manager.dispatch_hook,
+                          'rcpt', None, 'joe')
+        self.assertTrue(guard.breaker.open)
+
+        # The probe is killed part way through, another can take its place
+        self.plugin.error = None
+        self.plugin.delay = 1
+        job = gevent.spawn(self.manager.dispatch_hook, 'rcpt', None, 'joe')
+        gevent.sleep(0)
+        job.kill()
+        self.assertEqual(self.plugin.calls, 2)
+
+        self.plugin.delay = 0
+        self.assertEqual(self.manager.dispatch_hook('rcpt', None, 'joe'), None)
+        self.assertEqual(self.plugin.calls, 3)
+        self.assertFalse(guard.breaker.open)
+
+    def test_deregister(self):
+        self.register(hook_timeout=1)
+        self.manager.deregister_hook('rcpt', self.plugin.rcpt)
+        self.assertEqual(self.manager.hooks['rcpt'], ())
@@ -20,11 +20,18 @@
 #   Boston, MA    02110-1301, USA.
 #
 
+import gevent
+
 from gevent import socket
+from gevent.pool import Pool
 from cStringIO import StringIO
 from vsmtpd.connection import command
 from vsmtpd.connection import Connection
-from vsmtpd.tests.common import TestCase
+from vsmtpd.connection import quit_reply
+from vsmtpd.error import DenyError
+from vsmtpd.hooks import hook
+from vsmtpd.tests.common import TestCase, create_daemon
+from vsmtpd.verdict import DENY, DENYSOFT_DISCONNECT, DONE, OK
 
 localhost = socket.getfqdn('127.0.0.1')
 
@@ -36,6 +43,104 @@ class Socket(object):
     def makefile(self):
         return StringIO()
 
+class PipeSocket(Socket):
+    """
+    Socket that hands out pre-defined chunks of client data and records
+    each write made back to the client.
+    """
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+        self.writes = []
+
+    def recv(self, bufsize):
+        if not self.chunks:
+            return ''
+        data = self.chunks.pop(0)
+        if len(data) > bufsize:
+            self.chunks.insert(0, data[bufsize:])
+        return data[:bufsize]
+
+    def sendall(self, data):
+        self.writes.append(data)
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+class SilentSocket(PipeSocket):
+    """
+    Socket for a client that never sends anything.
+    """
+
+    def recv(self, bufsize):
+        gevent.sleep(10)
+        return ''
+
+class TrickleSocket(PipeSocket):
+    """
+    Socket for a client that sends the pre-defined chunks, then keeps on
+    sending a byte at a time.
+    """
+
+    def recv(self, bufsize):
+        if self.chunks:
+            return PipeSocket.recv(self, bufsize)
+        gevent.sleep(0.01)
+        return 'x'
+
+class QueuePlugin(object):
+
+    def __init__(self):
+        self.messages = []
+
+    @hook
+    def queue(self, transaction):
+        body = transaction.body
+        body.seek(0)
+        self.messages.append((transaction.headers['Subject'], body.read()))
+        return True
+
+class RcptPlugin(object):
+
+    def __init__(self, verdict=None, error=None):
+        self.verdict = verdict
+        self.error = error
+
+    @hook
+    def rcpt(self, transaction, rcpt):
+        if self.error:
+            raise self.error
+        return self.verdict
+
+class OkPlugin(object):
+
+    @hook
+    def mail(self, transaction, sender, params):
+        return OK
+
+    @hook
+    def rcpt(self, transaction, rcpt):
+        return OK
+
+    @hook
+    def data_post(self, transaction):
+        return OK
+
+class DonePlugin(object):
+    """
+    Plugin that takes over receiving the message, replying itself.
+    """
+
+    connection = None
+
+    @hook
+    def data(self):
+        self.connection.send_code(554, 'Handled elsewhere')
+        return DONE
+
 class Server(object):
 
     config = {}
@@ -64,3 +169,270 @@ class ConnectionTestCase(TestCase):
         self.assertEqual(connection.remote_port, 48765)
         self.assertEqual(connection.transaction, None)
 
+    def test_ehlo_advertises_pipelining(self):
+        sock = PipeSocket('EHLO client.example.com\r\n')
+        connection = Connection(create_daemon(), sock, ('127.0.0.1', 48765))
+        connection.accept()
+        self.assertTrue('250-PIPELINING\r\n' in ''.join(sock.writes))
+
+    def test_pipelined_replies_single_write(self):
+        sock = PipeSocket('EHLO client.example.com\r\n',
+                          'MAIL FROM:<john@example.com>\r\n'
+                          'RCPT TO:<joe@example.com>\r\n'
+                          'RCPT TO:<jane@example.com>\r\n'
+                          'DATA\r\n')
+        connection = Connection(create_daemon(), sock, ('127.0.0.1', 48765))
+        connection.accept()
+
+        # greeting, ehlo and then the whole pipelined batch in one write,
+        # followed by the reply to the aborted DATA.
+        self.assertEqual(len(sock.writes), 4)
+        replies = sock.writes[2].splitlines()
+        self.assertEqual([r[:3] for r in replies], ['250', '250', '250', '354'])
+
+    def test_quit_reply_cached(self):
+        reply = quit_reply('example.com')
+        self.assertEqual(reply, '221 example.com closing connection. '
+                                'Have a wonderful day.\r\n')
+        self.assertTrue(quit_reply('example.com') is reply)
+
+    def test_quit(self):
+        sock = PipeSocket('QUIT\r\nNOOP\r\n')
+        daemon = create_daemon()
+        daemon.config.set('helo_host', 'mx.example.com')
+        connection = Connection(daemon, sock, ('127.0.0.1', 48765))
+        connection.accept()
+
+        # Nothing is read or answered after the QUIT
+        self.assertEqual(sock.writes[-1], quit_reply('mx.example.com'))
+        self.assertEqual(sock.chunks, [])
+
+    def test_bdat(self):
+        message = 'Subject: Chunked\r\n\r\nThis is a chunked message.\r\n'
+        sock = PipeSocket('EHLO client.example.com\r\n',
+                          'MAIL FROM:<john@example.com>\r\n'
+                          'RCPT TO:<joe@example.com>\r\n'
+                          'BDAT 12\r\n' + message[:12],
+                          'BDAT %d LAST\r\n' % (len(message) - 12),
+                          message[12:] + 'QUIT\r\n')
+        daemon = create_daemon()
+        plugin = QueuePlugin()
+        daemon.hook_manager.register_object(plugin)
+        connection = Connection(daemon, sock, ('127.0.0.1', 48765))
+        connection.accept()
+
+        self.assertTrue('250 CHUNKING\r\n' in sock.writes[1])
+        replies = ''.join(sock.writes[2:]).splitlines()
+        self.assertEqual(replies[2], '250 12 octets received')
+        self.assertEqual(replies[3], '250 Queued')
+        self.assertEqual(replies[4][:3], '221')
+        self.assertEqual(plugin.messages, [('Chunked', message)])
+
+    def test_bdat_data_done(self):
+        sock = PipeSocket('EHLO client.example.com\r\n',
+                          'MAIL FROM:<john@example.com>\r\n'
+                          'RCPT TO:<joe@example.com>\r\n'
+                          'BDAT 6 LAST\r\nQUIT\r\nRSET\r\n')
+        daemon = create_daemon()
+        plugin = DonePlugin()
+        queue = QueuePlugin()
+        daemon.hook_manager.register_object(plugin)
+        daemon.hook_manager.register_object(queue)
+        connection = Connection(daemon, sock, ('127.0.0.1', 48765))
+        plugin.connection = connection
+        connection.accept()
+
+        # Only the plugin replies to the BDAT, the chunk is thrown away
+        # and nothing is queued.
+        replies = ''.join(sock.writes[2:]).splitlines()
+        self.assertEqual(replies[2:], ['554 Handled elsewhere', '250 OK'])
+        self.assertEqual(queue.messages, [])
+
+    def test_bdat_without_mail(self):
+        sock = PipeSocket('EHLO client.example.com\r\n',
+                          'BDAT 6 LAST\r\nQUIT\r\nRSET\r\n')
+        connection = Connection(create_daemon(), sock, ('127.0.0.1', 48765))
+        connection.accept()
+
+        # The chunk is still consumed so RSET is seen as the next command
+        replies = ''.join(sock.writes[2:]).splitlines()
+        self.assertEqual(replies, ['503 MAIL first please', '250 OK'])
+
+    def test_data(self):
+        sock = PipeSocket('EHLO client.example.com\r\n',
+                          'MAIL FROM:<john@example.com>\r\n'
+                          'RCPT TO:<joe@example.com>\r\n'
+                          'DATA\r\n',
+                          'Subject: Dotted\r\n\r\n..\r\n',
+                          '.\r\nQUIT\r\n')
+        daemon = create_daemon()
+        plugin = QueuePlugin()
+        daemon.hook_manager.register_object(plugin)
+        connection = Connection(daemon, sock, ('127.0.0.1', 48765))
+        connection.accept()
+
+        replies = ''.join(sock.writes[2:]).splitlines()
+        self.assertEqual(replies[2:4], ['354 go ahead', '250 Queued'])
+        self.assertEqual(replies[4][:3], '221')
+        self.assertEqual(plugin.messages,
+                         [('Dotted', 'Subject: Dotted\r\n\r\n.\r\n')])
+
+    def test_data_bare_lf(self):
+        sock = PipeSocket('HELO client.example.com\r\n',
+                          'MAIL FROM:<john@example.com>\r\n'
+                          'RCPT TO:<joe@example.com>\r\n'
+                          'DATA\r\n',
+                          'Subject: Bare\r\n\r\n.\n')
+        connection = Connection(create_daemon(), sock, ('127.0.0.1', 48765))
+        connection.accept()
+        self.assertEqual(sock.writes[-1][:4], '421 ')
+
+    def test_data_too_big(self):
+        sock = PipeSocket('EHLO client.example.com\r\n',
+                          'MAIL FROM:<john@example.com>\r\n'
+                          'RCPT TO:<joe@example.com>\r\n'
+                          'DATA\r\n',
+                          'Subject: Big\r\n\r\n' + 'x' * 100 + '\r\n',
+                          '.\r\nRSET\r\n')
+        daemon = create_daemon()
+        daemon.config.set('size_limit', '50')
+        connection = Connection(daemon, sock, ('127.0.0.1', 48765))
+        connection.accept()
+
+        replies = ''.join(sock.writes[2:]).splitlines()
+        self.assertEqual(replies[3:], ['552 Message too big!', '250 OK'])
+
+    def test_connection_id(self):
+        other = Connection(self.server, self.socket, ('127.0.0.1', 48766))
+        self.assertNotEqual(self.connection.id, other.id)
+        self.assertTrue(self.connection.id < other.id)
+
+    def test_command_table(self):
+        class SubConnection(Connection):
+            @command
+            def noop(self, line):
+                return 250, 'OK'
+
+        commands = Connection.command_table()
+        self.assertTrue('ehlo' in commands)
+        self.assertFalse('noop' in commands)
+        self.assertTrue(Connection.command_table() is commands)
+
+        sub_commands = SubConnection.command_table()
+        self.assertTrue('ehlo' in sub_commands)
+        self.assertTrue('noop' in sub_commands)
+
+    def test_greeting_timeout(self):
+        daemon = create_daemon()
+        daemon.sweeper.resolution = 0.01
+        daemon.sweeper.greeting = 0.05
+        sock = SilentSocket()
+        connection = Connection(daemon, sock, ('127.0.0.1', 48765))
+        gevent.spawn(connection.accept).join(1)
+        daemon.sweeper.stop()
+
+        self.assertEqual(sock.writes[-1][:4], '421 ')
+        self.assertEqual(len(daemon.sweeper), 0)
+
+    def test_reaped_when_busy(self):
+        daemon = create_daemon()
+        daemon.sweeper.resolution = 0.01
+        daemon.sweeper.pool = Pool(1)
+        sock = SilentSocket()
+        connection = Connection(daemon, sock, ('127.0.0.1', 48765))
+        daemon.sweeper.pool.spawn(connection.accept).join(1)
+        daemon.sweeper.stop()
+
+        self.assertEqual(sock.writes[-1],
+                         '421 Server busy, closing idle connection\r\n')
+
+    def test_bdat_data_timeout(self):
+        daemon = create_daemon()
+        daemon.sweeper.resolution = 0.01
+        daemon.sweeper.data = 0.1
+        sock = TrickleSocket('EHLO client.example.com\r\n',
+                             'MAIL FROM:<john@example.com>\r\n'
+                             'RCPT TO:<joe@example.com>\r\n'
+                             'BDAT 1000000 LAST\r\n')
+        connection = Connection(daemon, sock, ('127.0.0.1', 48765))
+        gevent.spawn(connection.accept).join(2)
+        daemon.sweeper.stop()
+
+        # Each byte arrives well within the block timeout, only the
+        # timeout on the whole transfer catches the client.
+        self.assertEqual(sock.writes[-1][:4], '421 ')
+        self.assertEqual(connection._data_deadline, None)
+
+    def test_mail_size(self):
+        connection = Connection(create_daemon(), PipeSocket(),
+                                ('127.0.0.1', 48765))
+        connection._hello = 'ehlo'
+        connection.mail('FROM:<john@example.com> SIZE=1000')
+        self.assertEqual(connection.transaction.declared_size, 1000)
+
+        # Starting a new transaction closes the old one
+        body = connection.transaction.body
+        connection.reset_transaction()
+        self.assertTrue(body.closed)
+
+    def test_mail_size_limited(self):
+        daemon = create_daemon()
+        daemon.config.set('size_limit', '5000')
+        connection = Connection(daemon, PipeSocket(), ('127.0.0.1', 48765))
+
+        # HELO clients aren't turned away for SIZE but the space set
+        # aside for their message still can't be more than the limit
+        connection._hello = 'helo'
+        connection.mail('FROM:<john@example.com> SIZE=1073741824')
+        self.assertEqual(connection.transaction.declared_size, 5000)
+
+    def test_rcpt_verdict(self):
+        for plugin, reply in (
+                (RcptPlugin(DENY), ('550 relaying denied', False)),
+                (RcptPlugin(DENY('No such user')), ('550 No such user', False)),
+                (RcptPlugin(DENYSOFT_DISCONNECT), ('450 relaying denied', True)),
+                (RcptPlugin(error=DenyError('Go away')), ('550 Go away', False))):
+            daemon = create_daemon()
+            daemon.hook_manager.register_object(plugin)
+            connection = Connection(daemon, PipeSocket(),
+                                    ('127.0.0.1', 48765))
+            connection._hello = 'helo'
+            connection.mail('FROM:<john@example.com>')
+            code, message, disconnect = connection.rcpt('TO:<joe@example.com>')
+            self.assertEqual(('%d %s' % (code, message), disconnect), reply)
+            self.assertEqual(connection.transaction.recipients, [])
+
+    def test_deferred(self):
+        connection = Connection(create_daemon(), PipeSocket(),
+                                ('127.0.0.1', 48765))
+        connection.defer('lookup', lambda a, b: a + b, 1, 2)
+        self.assertEqual(connection.deferred_result('lookup'), 3)
+        self.assertEqual(connection.deferred_result('missing', 0), 0)
+
+    def test_deferred_cancelled_on_disconnect(self):
+        connection = Connection(create_daemon(), PipeSocket('QUIT\r\n'),
+                                ('127.0.0.1', 48765))
+        deferred = connection.defer('lookup', gevent.sleep, 10)
+        connection.accept()
+        gevent.sleep(0)
+        self.assertTrue(deferred.ready)
+        self.assertEqual(connection.deferred_result('lookup', 0), 0)
+
+    def test_ok_verdicts(self):
+        sock = PipeSocket('EHLO client.example.com\r\n',
+                          'MAIL FROM:<john@example.com>\r\n'
+                          'RCPT TO:<joe@example.com>\r\n'
+                          'DATA\r\n',
+                          'Subject: Okay\r\n\r\nHello\r\n.\r\nQUIT\r\n')
+        daemon = create_daemon()
+        daemon.hook_manager.register_object(OkPlugin())
+        plugin = QueuePlugin()
+        daemon.hook_manager.register_object(plugin)
+        connection = Connection(daemon, sock, ('127.0.0.1', 48765))
+        connection.accept()
+
+        replies = ''.join(sock.writes[2:]).splitlines()
+        self.assertEqual([r[:3] for r in replies],
+                         ['250', '250', '354', '250', '221'])
+        self.assertEqual(replies[1], '250 <joe@example.com>, recipient ok')
+        self.assertEqual(len(plugin.messages), 1)
@@ -21,8 +21,12 @@
 #
 
 import os
-import logging
+import gevent
 
+from gevent import socket
+from gevent.pool import Pool
+from vsmtpd.daemon import BUSY_REPLY, LIMITED_REPLY, turn_away
+from vsmtpd.metrics import metrics
 from vsmtpd.tests.common import TestCase, create_daemon
 
 class DaemonTestCase(TestCase):
@@ -39,3 +43,69 @@ class DaemonTestCase(TestCase):
         vsmtpd._config.add_section('plugin:simple_valid_plugin')
         vsmtpd._config.add_section('plugin:queue.simple_valid_plugin')
         vsmtpd.load_plugins()
+
+    def test_daemon_load_guarded_plugin(self):
+        vsmtpd = create_daemon(port=2500)
+        vsmtpd.plugin_manager.path.append(os.path.join(os.path.dirname(__file__), 'pluginsdir'))
+        vsmtpd._config.add_section('plugin:simple_valid_plugin')
+        vsmtpd._config.set('plugin:simple_valid_plugin', 'hook_timeout', '5')
+        vsmtpd._config.set('plugin:simple_valid_plugin', 'rcpt_hook_timeout', '1')
+        vsmtpd.load_plugins()
+    def test_shed_when_full(self):
+        vsmtpd = create_daemon()
+        vsmtpd.pool = Pool(1)
+        server = vsmtpd.create_server(('127.0.0.1', 0))
+        server.start()
+        shed = metrics['connections.shed']
+
+        blocker = vsmtpd.pool.spawn(gevent.sleep, 10)
+        try:
+            sock = socket.create_connection(server.address)
+            self.assertEqual(sock.recv(1024), BUSY_REPLY)
+            self.assertEqual(sock.recv(1024), '')
+            sock.close()
+        finally:
+            blocker.kill()
+            server.stop()
+
+        self.assertEqual(metrics['connections.shed'], shed + 1)
+
+    def test_turn_away_never_blocks(self):
+        class Socket(object):
+            def setblocking(self, flag):
+                self.blocking = flag
+            def send(self, data):
+                raise gevent.hub.BlockingSwitchOutError('would block')
+        sock = Socket()
+        turn_away(sock, BUSY_REPLY)
+        self.assertEqual(sock.blocking, 0)
+
+    def test_invalid_pool_full_policy(self):
+        vsmtpd = create_daemon()
+        vsmtpd.config.set('pool_full_policy', 'drop')
+        self.assertRaises(ValueError, vsmtpd.create_server,
+                          ('127.0.0.1', 0))
+
+    def test_no_per_ip_limit_by_default(self):
+        vsmtpd = create_daemon()
+        self.assertEqual(vsmtpd.limiter.per_ip, 0)
+        self.assertEqual(vsmtpd.limiter.per_network, 0)
+        for i in xrange(50):
+            self.assertTrue(vsmtpd.limiter.acquire('127.0.0.1'))
+
+    def test_per_ip_limit(self):
+        vsmtpd = create_daemon()
+        vsmtpd.limiter.per_ip = 1
+        vsmtpd.limiter.acquire('127.0.0.1')
+        server = vsmtpd.create_server(('127.0.0.1', 0))
+        server.start()
+        limited = metrics['connections.limited']
+
+        try:
+            sock = socket.create_connection(server.address)
+            self.assertEqual(sock.recv(1024), LIMITED_REPLY)
+            sock.close()
+        finally:
+            server.stop()
+
+        self.assertEqual(metrics['connections.limited'], limited + 1)
@@ -0,0 +1,83 @@
+#
+# vsmtpd/tests/test_deferred.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+
+import gevent
+
+from vsmtpd.deferred import Deferred
+from vsmtpd.metrics import metrics
+from vsmtpd.tests.common import TestCase
+
+def sleep(delay, result):
+    gevent.sleep(delay)
+    return result
+
+def fail():
+    raise ValueError('lookup failed')
+
+class DeferredTestCase(TestCase):
+
+    def test_get(self):
+        hidden = metrics['deferred.hidden_ms']
+        deferred = Deferred(sleep, (0.05, 'listed'))
+        gevent.sleep(0.1)
+        self.assertTrue(deferred.ready)
+        self.assertEqual(deferred.get(), 'listed')
+        self.assertTrue(metrics['deferred.hidden_ms'] - hidden >= 40)
+
+    def test_get_waits(self):
+        waited = metrics['deferred.waited_ms']
+        deferred = Deferred(sleep, (0.05, 'listed'))
+        self.assertEqual(deferred.get(), 'listed')
+        self.assertTrue(metrics['deferred.waited_ms'] - waited >= 40)
+
+    def test_timeout(self):
+        timed_out = metrics['deferred.timed_out']
+        deferred = Deferred(sleep, (1, 'listed'), timeout=0.05)
+        self.assertEqual(deferred.get('default'), 'default')
+        self.assertEqual(metrics['deferred.timed_out'], timed_out + 1)
+        gevent.sleep(0)
+        self.assertTrue(deferred.ready)
+
+        # Later calls keep getting the default, not the GreenletExit
+        self.assertEqual(deferred.get(False), False)
+        self.assertEqual(metrics['deferred.timed_out'], timed_out + 1)
+
+    def test_cancel(self):
+        cancelled = metrics['deferred.cancelled']
+        deferred = Deferred(sleep, (1, 'listed'))
+        deferred.cancel()
+        gevent.sleep(0)
+        self.assertTrue(deferred.ready)
+        self.assertEqual(metrics['deferred.cancelled'], cancelled + 1)
+        self.assertEqual(deferred.get(False), False)
+        self.assertEqual(deferred.get(False), False)
+
+    def test_killed(self):
+        deferred = Deferred(sleep, (1, 'listed'))
+        gevent.sleep(0)
+        deferred._job.kill()
+        self.assertEqual(deferred.get(False), False)
+
+    def test_failure(self):
+        deferred = Deferred(fail)
+        self.assertRaises(ValueError, deferred.get)
@@ -0,0 +1,135 @@
+#
+# vsmtpd/tests/test_headers.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from email.feedparser import FeedParser
+from vsmtpd.headers import HeaderParser, Message
+from vsmtpd.tests.common import TestCase
+
+HEADERS = ('Received: from mx.example.com (mx.example.com [192.0.2.1])\r\n'
+           '\tby mail.example.com; Fri, 25 Mar 2011 13:35:33 -0000\r\n'
+           'Subject: blah blah\r\n'
+           'From: John Smith <john@example.com>\r\n'
+           'To: Joe Bloggs <joe@example.com>,\r\n'
+           ' Jane Bloggs <jane@example.com>\r\n'
+           'X-Empty:\r\n'
+           '\r\n')
+
+def parse(*chunks):
+    parser = HeaderParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+class HeaderParserTestCase(TestCase):
+
+    def test_matches_feedparser(self):
+        parser = FeedParser(Message)
+        parser.feed(HEADERS)
+        expected = parser.close()
+
+        msg = parse(HEADERS[:50], HEADERS[50:])
+        self.assertTrue(isinstance(msg, Message))
+        self.assertEqual(msg.items(), expected.items())
+
+    def test_unixfrom(self):
+        msg = parse('From john@example.com Fri Mar 25 13:35:33 2011\n'
+                    'Subject: blah blah\n\n')
+        self.assertEqual(msg.get_unixfrom(),
+                         'From john@example.com Fri Mar 25 13:35:33 2011')
+        self.assertEqual(msg.items(), [('Subject', 'blah blah')])
+
+    def test_malformed(self):
+        msg = parse(' leading continuation\r\nSubject: blah\r\n'
+                    'not a header\r\n\r\n')
+        self.assertEqual(msg.items(), [('Subject', 'blah')])
+        self.assertEqual(len(msg.defects), 1)
+
+    def test_empty(self):
+        self.assertEqual(parse('\r\n').items(), [])
+
+    def test_end_of_headers(self):
+        parser = HeaderParser()
+        self.assertFalse(parser.feed('Subject: blah\r\nX-Split'))
+        self.assertTrue(parser.feed(': yes\r\n\r\nbody\r\n'))
+        self.assertEqual(parser.body_start, 31)
+        self.assertEqual(parser.close().items(),
+                         [('Subject', 'blah'), ('X-Split', 'yes')])
+
+    def test_missing_separator(self):
+        # The first line that isn't a header starts the body, even when
+        # it was split across chunks
+        parser = HeaderParser()
+        self.assertFalse(parser.feed('Subject: blah\r\nHello '))
+        self.assertTrue(parser.feed('there\r\nFoo: bar\r\n'))
+        self.assertEqual(parser.body_start, 15)
+        self.assertEqual(parser.carried, 'Hello ')
+        msg = parser.close()
+        self.assertEqual(msg.items(), [('Subject', 'blah')])
+
+    def test_max_size(self):
+        parser = HeaderParser(max_size=100)
+        for i in xrange(20):
+            if parser.feed('X-Header-%02d: value\r\n' % i):
+                break
+        self.assertEqual(parser.body_start, 100)
+        self.assertEqual(len(parser.close().keys()), 5)
+
+class MessageTestCase(TestCase):
+
+    def test_dirty(self):
+        msg = parse(HEADERS)
+        self.assertFalse(msg.dirty)
+
+        msg.prepend_header('Received', 'from me\n\tby you')
+        self.assertFalse(msg.dirty)
+        self.assertEqual(msg.keys()[0], 'Received')
+        self.assertEqual(msg.prepended_block(),
+                         'Received: from me\r\n\tby you\r\n')
+
+        msg['X-Spam'] = 'no'
+        self.assertTrue(msg.dirty)
+
+    def test_insert_header_dirty(self):
+        msg = parse(HEADERS)
+        msg.insert_header(0, 'X-Test', 'vsmtpd')
+        self.assertTrue(msg.dirty)
+
+    def test_index(self):
+        msg = parse(HEADERS[:-2] + 'received: from elsewhere\r\n\r\n')
+        self.assertEqual(msg.header_count('RECEIVED'), 2)
+        self.assertEqual(msg.header_count('X-Missing'), 0)
+        self.assertEqual(msg.get_all('received')[1], 'from elsewhere')
+        self.assertEqual(msg.get_all('X-Missing', []), [])
+        self.assertEqual(msg['subject'], 'blah blah')
+        self.assertTrue('SUBJECT' in msg)
+        self.assertFalse('X-Missing' in msg)
+
+    def test_index_updated(self):
+        msg = parse(HEADERS)
+        msg.prepend_header('Received', 'by me')
+        self.assertEqual(msg.get_all('Received')[0], 'by me')
+        self.assertEqual(msg['Subject'], 'blah blah')
+
+        del msg['Received']
+        self.assertEqual(msg.header_count('Received'), 0)
+        msg['Received'] = 'by you'
+        self.assertEqual(msg.get_all('Received'), ['by you'])
@@ -20,10 +20,14 @@
 #   Boston, MA    02110-1301, USA.
 #
 
-from vsmtpd.error import HookNotFoundError
+import time
+import gevent
+
+from vsmtpd.error import DenySoftError, HookNotFoundError
 from vsmtpd.hooks import hook
 from vsmtpd.hooks import HookManager
 from vsmtpd.tests.common import TestCase
+from vsmtpd.verdict import DENY, DENYSOFT, OK
 
 class SamplePlugin(object):
 
@@ -39,6 +43,24 @@ class SamplePlugin(object):
     def bar(self, *args):
         pass
 
+class ParallelPlugin(object):
+
+    def __init__(self, delay, result=None):
+        self.delay = delay
+        self.result = result
+        self.finished = False
+        self.cancelled = False
+
+    @hook(parallel=True)
+    def connect(self, connection):
+        try:
+            gevent.sleep(self.delay)
+        except gevent.GreenletExit:
+            self.cancelled = True
+            raise
+        self.finished = True
+        return self.result
+
 class HookDecoratorTestCase(TestCase):
 
     @hook('rcpt')
@@ -60,6 +82,12 @@ class HookDecoratorTestCase(TestCase):
     def test_hook_decorator_no_arguments(self):
         self.assertRaises(TypeError, hook)
 
+    def test_hook_decorator_parallel(self):
+        self.assertTrue(ParallelPlugin.connect._hook_parallel)
+        self.assertEqual(ParallelPlugin.connect._hook_names, ('connect',))
+        self.assertFalse(SamplePlugin.rcpt._hook_parallel)
+        self.assertRaises(TypeError, hook, 'rcpt', foo=True)
+
 class HookManagerTestCase(TestCase):
 
     def setUp(self):
@@ -82,3 +110,66 @@ class HookManagerTestCase(TestCase):
     def test_deregister_missing_hook(self):
         self.assertRaises(HookNotFoundError, self.manager.deregister_hook,
                           'foo', None)
+
+    def test_compiled_hooks(self):
+        plugin = SamplePlugin()
+        self.manager.register_object(plugin)
+        self.assertTrue(isinstance(self.manager.hooks['rcpt'], tuple))
+        self.assertTrue(self.manager.has_handlers('connect'))
+        self.manager.deregister_hook('connect', plugin.bar)
+        self.assertEqual(self.manager.hooks['connect'], ())
+        self.assertFalse(self.manager.has_handlers('connect'))
+
+    def test_dispatch_empty_hook(self):
+        self.assertEqual(self.manager.dispatch_hook('rcpt', None), None)
+
+    def test_dispatch_hook_result(self):
+        class Plugin(object):
+            @hook('rcpt')
+            def first(self, addr):
+                return None
+            @hook('rcpt')
+            def second(self, addr):
+                return addr
+        self.manager.register_object(Plugin())
+        self.assertEqual(self.manager.dispatch_hook('rcpt', 'joe'), 'joe')
+
+    def test_dispatch_missing_hook(self):
+        self.assertRaises(KeyError, self.manager.dispatch_hook, 'foo')
+
+    def test_dispatch_hook_error(self):
+        class Plugin(object):
+            @hook('rcpt')
+            def deny(self, addr):
+                raise DenySoftError('Try later')
+        self.manager.register_object(Plugin())
+        self.assertEqual(self.manager.dispatch_hook('rcpt', 'joe'),
+                         DENYSOFT('Try later'))
+
+    def test_dispatch_parallel(self):
+        plugins = [ParallelPlugin(0.1) for i in xrange(3)]
+        for plugin in plugins:
+            self.manager.register_object(plugin)
+
+        start = time.time()
+        self.assertEqual(self.manager.dispatch_hook('connect', None), None)
+        self.assertTrue(time.time() - start < 0.25)
+        self.assertTrue(all([p.finished for p in plugins]))
+
+    def test_dispatch_parallel_order(self):
+        # The slower handler was registered first so its verdict wins
+        slow = ParallelPlugin(0.05, OK)
+        fast = ParallelPlugin(0, DENY)
+        self.manager.register_object(slow)
+        self.manager.register_object(fast)
+        self.assertTrue(self.manager.dispatch_hook('connect', None) is OK)
+
+    def test_dispatch_parallel_cancels(self):
+        fast = ParallelPlugin(0, DENY)
+        slow = ParallelPlugin(1)
+        self.manager.register_object(fast)
+        self.manager.register_object(slow)
+        self.assertTrue(self.manager.dispatch_hook('connect', None) is DENY)
+        gevent.sleep(0)
+        self.assertTrue(slow.cancelled)
+        self.assertFalse(slow.finished)
@@ -0,0 +1,82 @@
+#
+# vsmtpd/tests/test_limits.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+
+from vsmtpd.limits import ConnectionLimiter, network
+from vsmtpd.tests.common import TestCase
+
+class NetworkTestCase(TestCase):
+
+    def test_ipv4(self):
+        self.assertEqual(network('192.0.2.1'), '192.0.2.0/24')
+
+    def test_ipv6(self):
+        self.assertEqual(network('2001:db8:1:2:3::4'), '2001:db8:1:2::/64')
+
+    def test_ipv4_mapped(self):
+        self.assertEqual(network('::ffff:192.0.2.1'), '192.0.2.0/24')
+
+class ConnectionLimiterTestCase(TestCase):
+
+    def test_per_ip(self):
+        limiter = ConnectionLimiter(2, 0)
+        self.assertTrue(limiter.acquire('192.0.2.1'))
+        self.assertTrue(limiter.acquire('192.0.2.1'))
+        self.assertFalse(limiter.acquire('192.0.2.1'))
+        self.assertTrue(limiter.acquire('192.0.2.2'))
+
+        limiter.release('192.0.2.1')
+        self.assertTrue(limiter.acquire('192.0.2.1'))
+
+    def test_per_network(self):
+        limiter = ConnectionLimiter(2, 3)
+        for ip in ('192.0.2.1', '192.0.2.1', '192.0.2.2'):
+            self.assertTrue(limiter.acquire(ip))
+
+        self.assertFalse(limiter.acquire('192.0.2.3'))
+        self.assertTrue(limiter.acquire('198.51.100.1'))
+
+        # A rejected connection mustn't be left counted
+        limiter.release('192.0.2.2')
+        self.assertTrue(limiter.acquire('192.0.2.3'))
+
+    def test_release_cleans_up(self):
+        limiter = ConnectionLimiter(2, 3)
+        limiter.acquire('192.0.2.1')
+        limiter.release('192.0.2.1')
+        self.assertEqual(limiter._counter._counts, {})
+
+    def test_shared(self):
+        limiter = ConnectionLimiter(1, 0, shared=True, slots=64)
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if limiter.acquire('192.0.2.1') else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        # The child's connection is still counted here
+        self.assertFalse(limiter.acquire('192.0.2.1'))
+
+        # Which is how a dead worker's connections stay counted until
+        # the counts are reset
+        limiter._counter.reset()
+        self.assertTrue(limiter.acquire('192.0.2.1'))
@@ -0,0 +1,53 @@
+#
+# vsmtpd/tests/test_resolver.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from gevent import socket
+from vsmtpd import resolver
+from vsmtpd.tests.common import TestCase
+
+localhost = socket.getfqdn('127.0.0.1')
+
+class ResolverTestCase(TestCase):
+
+    def setUp(self):
+        resolver.cache.clear()
+
+    def test_get_host(self):
+        self.assertEqual(resolver.get_host('127.0.0.1'), localhost)
+        self.assertEqual(resolver.cache.get('127.0.0.1'), localhost)
+
+    def test_start_lookup(self):
+        job = resolver.start_lookup('127.0.0.1')
+        self.assertTrue(resolver.start_lookup('127.0.0.1') is job)
+        self.assertEqual(resolver.get_host('127.0.0.1', job), localhost)
+        self.assertEqual(resolver.start_lookup('127.0.0.1'), None)
+
+    def test_cached(self):
+        resolver.cache.set('192.0.2.1', 'cached.example.com')
+        self.assertEqual(resolver.start_lookup('192.0.2.1'), None)
+        self.assertEqual(resolver.get_host('192.0.2.1'), 'cached.example.com')
+
+    def test_local_host(self):
+        self.assertEqual(resolver.local_host('127.0.0.1'), localhost)
+
+    def tearDown(self):
+        resolver.cache.clear()
@@ -0,0 +1,314 @@
+#
+# vsmtpd/tests/test_spool.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+from vsmtpd import spool as spool_module
+from vsmtpd.metrics import metrics
+from vsmtpd.spool import ChunkedBuffer, MemoryBudget, Spool, parse_digests
+from vsmtpd.tests.common import TestCase
+
+DATA = ''.join(['line %d of the message\r\n' % i for i in xrange(100)])
+
+class ChunkedBufferTestCase(TestCase):
+
+    def setUp(self):
+        self.buf = ChunkedBuffer(chunksize=64)
+        for pos in xrange(0, len(DATA), 7):
+            self.buf.write(DATA[pos:pos + 7])
+
+    def test_write(self):
+        self.assertEqual(self.buf.tell(), len(DATA))
+        self.assertEqual(len(self.buf), len(DATA))
+        self.assertEqual(self.buf.getvalue(), DATA)
+        self.assertTrue(len(self.buf._chunks) > 1)
+
+    def test_read(self):
+        self.buf.seek(10)
+        self.assertEqual(self.buf.read(100), DATA[10:110])
+        self.assertEqual(self.buf.tell(), 110)
+        self.assertEqual(self.buf.read(), DATA[110:])
+        self.assertEqual(self.buf.read(), '')
+
+    def test_readline(self):
+        self.buf.seek(0)
+        self.assertEqual(list(self.buf), DATA.splitlines(True))
+
+        self.buf.seek(3)
+        self.assertEqual(self.buf.readline(5), DATA[3:8])
+
+    def test_seek(self):
+        self.buf.seek(-5, 2)
+        self.assertEqual(self.buf.read(), DATA[-5:])
+        self.buf.seek(-10, 1)
+        self.assertEqual(self.buf.tell(), len(DATA) - 10)
+
+    def test_write_appends(self):
+        self.buf.seek(0)
+        self.buf.write('end\r\n')
+        self.assertEqual(self.buf.getvalue(), DATA + 'end\r\n')
+
+    def test_drain(self):
+        self.assertEqual(''.join(self.buf.drain()), DATA)
+        self.assertEqual(self.buf._chunks, [])
+
+class SpoolTestCase(TestCase):
+
+    def test_rollover(self):
+        spool = Spool()
+        spool._rollover = 1024
+        spool.write('Subject: rollover\r\n\r\n')
+        for i in xrange(100):
+            spool.write(DATA[:50])
+        self.assertTrue(spool.on_disk)
+
+        spool.seek(0)
+        self.assertEqual(spool.read(), 'Subject: rollover\r\n\r\n' +
+                         DATA[:50] * 100)
+        spool.close()
+
+    def test_link(self):
+        directory = tempfile.mkdtemp()
+        try:
+            spool = Spool(directory)
+            spool.write('Subject: link\r\n\r\nbody\r\n')
+            filename = spool.link()
+            self.assertEqual(os.path.dirname(filename), directory)
+            self.assertEqual(spool.link(), filename)
+            self.assertEqual(open(filename).read(),
+                             'Subject: link\r\n\r\nbody\r\n')
+
+            spool.close()
+            self.assertFalse(os.path.exists(filename))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cloexec(self):
+        spool = Spool()
+        spool.write('Subject: cloexec\r\n\r\n')
+        spool.link()
+        flags = fcntl.fcntl(spool.fileno(), fcntl.F_GETFD)
+        self.assertTrue(flags & fcntl.FD_CLOEXEC)
+        spool.close()
+
+    def test_no_o_tmpfile(self):
+        directory = tempfile.mkdtemp()
+        o_tmpfile = spool_module.O_TMPFILE
+        spool_module.O_TMPFILE = None
+        try:
+            spool = Spool(directory)
+            spool.write('Subject: named\r\n\r\n')
+            spool.flush()
+            self.assertEqual(os.listdir(directory),
+                             [os.path.basename(spool.name)])
+            self.assertEqual(spool.link(), spool.name)
+            spool.close()
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            spool_module.O_TMPFILE = o_tmpfile
+            shutil.rmtree(directory)
+
+    def test_preallocate(self):
+        spool = Spool(size=1048576)
+        spool.write('Subject: preallocated\r\n\r\n')
+        spool.flush()
+
+        # The space is allocated without the file appearing any larger
+        st = os.fstat(spool.fileno())
+        self.assertEqual(st.st_size, 25)
+        self.assertTrue(st.st_blocks * 512 >= 1048576)
+        spool.seek(0)
+        self.assertEqual(spool.read(), 'Subject: preallocated\r\n\r\n')
+        spool.close()
+
+    def test_preallocate_limit(self):
+        max_preallocate = spool_module.MAX_PREALLOCATE
+        spool_module.MAX_PREALLOCATE = 65536
+        try:
+            spool = Spool(size=1073741824)
+            spool.write('Subject: preallocated\r\n\r\n')
+            spool.flush()
+            st = os.fstat(spool.fileno())
+            self.assertTrue(st.st_blocks * 512 < 1048576)
+            spool.close()
+        finally:
+            spool_module.MAX_PREALLOCATE = max_preallocate
+
+    def test_header_block(self):
+        spool = Spool()
+        spool.write('Subject:   spaced  \r\nTo: <joe@example.com>\r\n\r\n')
+        spool.write('body\r\n')
+        spool.headers.prepend_header('Received', 'by me')
+        self.assertEqual(spool.header_block(),
+                         'Received: by me\r\n'
+                         'Subject:   spaced  \r\nTo: <joe@example.com>\r\n\r\n')
+        self.assertEqual(spool.tell(), spool.body_start + 6)
+
+        # Once changed the headers are regenerated
+        del spool.headers['To']
+        self.assertEqual(spool.header_block(),
+                         'Received: by me\r\nSubject: spaced  \r\n\r\n')
+        spool.close()
+
+class MemfdSpoolTestCase(TestCase):
+
+    def test_link(self):
+        spool = Spool(memfd_limit=4096)
+        spool.write('Subject: memfd\r\n\r\nbody\r\n')
+        filename = spool.link()
+        self.assertEqual(spool.backend, 'memfd')
+        self.assertTrue(filename.startswith('/proc/%d/fd/' % os.getpid()))
+        self.assertEqual(open(filename).read(),
+                         'Subject: memfd\r\n\r\nbody\r\n')
+
+        # Writing continues where it left off
+        spool.write('more\r\n')
+        spool.seek(0)
+        self.assertEqual(spool.read(), 'Subject: memfd\r\n\r\nbody\r\nmore\r\n')
+        spool.close()
+
+    def test_rollover(self):
+        spool = Spool(memfd_limit=4096)
+        spool._rollover = 1024
+        spool.write('Subject: memfd\r\n\r\n')
+        spool.write('x' * 2048)
+        self.assertEqual(spool.backend, 'memfd')
+
+        # Growing past the limit moves it to disk
+        spool.write('y' * 4096)
+        self.assertEqual(spool.backend, 'disk')
+        spool.seek(0)
+        self.assertEqual(spool.read(),
+                         'Subject: memfd\r\n\r\n' + 'x' * 2048 + 'y' * 4096)
+        spool.close()
+
+    def test_declared_size(self):
+        spool = Spool(size=8192, memfd_limit=4096)
+        spool.write('Subject: memfd\r\n\r\n')
+        spool.link()
+        self.assertEqual(spool.backend, 'disk')
+        spool.close()
+
+    def test_no_memfd(self):
+        memfd_create = spool_module.memfd_create
+        def unsupported(name):
+            raise OSError(38, 'Function not implemented')
+        spool_module.memfd_create = unsupported
+        try:
+            spool = Spool(memfd_limit=4096)
+            spool.write('Subject: memfd\r\n\r\n')
+            spool.link()
+            self.assertEqual(spool.backend, 'disk')
+            spool.close()
+        finally:
+            spool_module.memfd_create = memfd_create
+
+class MemoryBudgetTestCase(TestCase):
+
+    def setUp(self):
+        self.budget = MemoryBudget(4096, pressure=0.5, rollover=1024)
+
+    def test_reserve(self):
+        self.assertTrue(self.budget.reserve(1000))
+        self.assertTrue(self.budget.reserve(1000, held=1000))
+        self.assertEqual(self.budget.used, 2000)
+
+        # Under pressure only small spools get more
+        self.assertFalse(self.budget.reserve(1000, held=2000))
+        self.assertTrue(self.budget.reserve(500))
+        self.assertFalse(self.budget.reserve(2000))
+
+        self.budget.release(2500)
+        self.assertEqual(self.budget.used, 0)
+
+    def test_large_message_when_idle(self):
+        spool = Spool(budget=self.budget)
+        spool.write('Subject: budget\r\n\r\n')
+        spool.write('x' * 1500)
+        self.assertEqual(spool.backend, 'memory')
+        self.assertEqual(self.budget.used, 1519)
+
+        spool.close()
+        self.assertEqual(self.budget.used, 0)
+
+    def test_spill(self):
+        spills = metrics['spool.spills']
+        small = Spool(budget=self.budget)
+        small.write('x' * 500)
+        large = Spool(budget=self.budget)
+        large.write('x' * 1000)
+        large.write('x' * 500)
+        self.assertEqual(large.backend, 'memory')
+
+        # The budget is under pressure so the large message is spilled
+        large.write('x' * 1000)
+        self.assertEqual(large.backend, 'disk')
+        self.assertEqual(self.budget.used, 500)
+        self.assertEqual(metrics['spool.spills'], spills + 1)
+
+        large.seek(0)
+        self.assertEqual(large.read(), 'x' * 2500)
+        small.close()
+        large.close()
+
+class DigestTestCase(TestCase):
+
+    def test_parse_digests(self):
+        self.assertEqual(parse_digests('sha256, MD5,,body:sha256'),
+                         ('sha256', 'md5', 'body:sha256'))
+        self.assertEqual(parse_digests(None), ())
+        self.assertRaises(ValueError, parse_digests, 'body:nohash')
+
+    def test_digests(self):
+        message = 'Subject: digest\r\n\r\n' + DATA
+        spool = Spool(digests=('sha256', 'md5', 'body:sha256'))
+        for pos in xrange(0, len(message), 10):
+            spool.write(message[pos:pos + 10])
+
+        self.assertEqual(spool.digests, {
+            'sha256': hashlib.sha256(message).hexdigest(),
+            'md5': hashlib.md5(message).hexdigest(),
+            'body:sha256': hashlib.sha256(DATA).hexdigest()
+        })
+        spool.close()
+
+    def test_missing_separator(self):
+        # Without a blank line the body starts at the first line that
+        # isn't a header
+        message = 'Subject: digest\r\n' + DATA
+        spool = Spool(digests=('body:sha256',))
+        for pos in xrange(0, len(message), 10):
+            spool.write(message[pos:pos + 10])
+
+        self.assertEqual(spool.body_start, 17)
+        self.assertEqual(spool.headers.items(), [('Subject', 'digest')])
+        self.assertEqual(spool.digests['body:sha256'],
+                         hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(spool.view()[spool.body_start:].tobytes(), DATA)
+        spool.close()
+
+    def test_no_digests(self):
+        self.assertEqual(Spool().digests, {})
@@ -0,0 +1,99 @@
+#
+# vsmtpd/tests/test_store.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+from vsmtpd.metrics import metrics
+from vsmtpd.store import BlobStore
+from vsmtpd.transaction import Transaction
+from vsmtpd.tests.common import TestCase
+
+BODY = 'This is a body sent to many recipients.\r\n' * 10
+
+class Connection(object):
+
+    def __init__(self, store):
+        self.blob_store = store
+        self.spool_options = {'digests': ('body:sha256',)}
+
+class BlobStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = BlobStore(self.directory)
+
+    def test_store(self):
+        blob = self.store.store(BODY)
+        digest = hashlib.sha256(BODY).hexdigest()
+        self.assertEqual(blob.digest, digest)
+        self.assertEqual(open(blob.path).read(), BODY)
+        self.assertEqual(blob.refcount, 1)
+
+        blob.release()
+        self.assertFalse(os.path.exists(self.store.path(digest)))
+
+    def test_deduplicate(self):
+        deduplicated = metrics['store.deduplicated']
+        first = self.store.store(BODY)
+        second = self.store.store(BODY)
+        self.assertEqual(first.refcount, 2)
+        self.assertEqual(os.stat(first.path).st_ino,
+                         os.stat(second.path).st_ino)
+        self.assertEqual(metrics['store.deduplicated'], deduplicated + 1)
+
+        first.release()
+        self.assertEqual(second.refcount, 1)
+        self.assertEqual(open(second.path).read(), BODY)
+        second.release()
+        self.assertFalse(os.path.exists(self.store.path(second.digest)))
+
+    def test_link(self):
+        blob = self.store.store(BODY)
+        path = os.path.join(self.directory, 'queued')
+        blob.link(path)
+        blob.release()
+        self.assertEqual(open(path).read(), BODY)
+
+    def test_transaction(self):
+        blobs = []
+        for i in xrange(2):
+            tnx = Transaction(Connection(self.store))
+            tnx.body.write('Subject: message %d\r\n\r\n' % i)
+            tnx.body.write(BODY)
+            blobs.append(tnx.body_blob)
+            self.assertTrue(tnx.body_blob is blobs[-1])
+
+        self.assertEqual(blobs[0].digest, tnx.digests['body:sha256'])
+        self.assertEqual(blobs[1].refcount, 2)
+        self.assertEqual(open(blobs[1].path).read(), BODY)
+
+        tnx.close()
+        self.assertEqual(blobs[0].refcount, 1)
+
+    def test_no_store(self):
+        self.assertEqual(Transaction(None).body_blob, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
@@ -0,0 +1,146 @@
+#
+# vsmtpd/tests/test_stream.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from vsmtpd.stream import DataDecoder, Stream, format_reply
+from vsmtpd.tests.common import TestCase
+
+class Socket(object):
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+        self.writes = []
+
+    def recv(self, bufsize):
+        if not self.chunks:
+            return ''
+        data = self.chunks.pop(0)
+        if len(data) > bufsize:
+            self.chunks.insert(0, data[bufsize:])
+        return data[:bufsize]
+
+    def sendall(self, data):
+        self.writes.append(data)
+
+class FormatReplyTestCase(TestCase):
+
+    def test_single_line(self):
+        self.assertEqual(format_reply(250, 'OK'), '250 OK\r\n')
+
+    def test_multi_line(self):
+        self.assertEqual(format_reply(250, 'example.com\nPIPELINING\nSIZE 10'),
+            '250-example.com\r\n250-PIPELINING\r\n250 SIZE 10\r\n')
+
+    def test_empty(self):
+        self.assertEqual(format_reply(354), '354 \r\n')
+
+class DataDecoderTestCase(TestCase):
+
+    def decode(self, *blocks):
+        decoder = DataDecoder()
+        data = []
+        for i, block in enumerate(blocks):
+            data.append(decoder.feed(block))
+            if decoder.done:
+                decoder.rest += ''.join(blocks[i + 1:])
+                break
+        return decoder, ''.join(data)
+
+    def test_end_of_data(self):
+        decoder, data = self.decode('Subject: test\r\n\r\nbody\r\n.\r\nQUIT\r\n')
+        self.assertTrue(decoder.done)
+        self.assertEqual(data, 'Subject: test\r\n\r\nbody\r\n')
+        self.assertEqual(decoder.rest, 'QUIT\r\n')
+
+    def test_empty_message(self):
+        decoder, data = self.decode('.\r\n')
+        self.assertTrue(decoder.done)
+        self.assertEqual(data, '')
+
+    def test_unstuffing(self):
+        decoder, data = self.decode('..\r\n...foo\r\n.bar\r\n.\r\n')
+        self.assertTrue(decoder.done)
+        self.assertEqual(data, '.\r\n..foo\r\nbar\r\n')
+
+    def test_unstuffing_single_dot(self):
+        message = 'line one\r\n.foo\r\n.\r\n'
+        for i in xrange(1, len(message)):
+            decoder, data = self.decode(message[:i], message[i:])
+            self.assertTrue(decoder.done)
+            self.assertEqual(data, 'line one\r\nfoo\r\n')
+
+    def test_split_across_blocks(self):
+        message = 'line one\r\n..stuffed\r\nline three\r\n.\r\nQUIT\r\n'
+        for i in xrange(1, len(message)):
+            decoder, data = self.decode(message[:i], message[i:])
+            self.assertTrue(decoder.done)
+            self.assertEqual(data, 'line one\r\n.stuffed\r\nline three\r\n')
+            self.assertEqual(decoder.rest, 'QUIT\r\n')
+
+    def test_incomplete(self):
+        decoder, data = self.decode('line one\r\n.')
+        self.assertFalse(decoder.done)
+        self.assertEqual(data, 'line one\r\n')
+
+    def test_bare_lf(self):
+        decoder, data = self.decode('line one\r\n', '.\nline two\r\n')
+        self.assertTrue(decoder.bare_lf)
+        self.assertFalse(decoder.done)
+
+class StreamTestCase(TestCase):
+
+    def test_readline(self):
+        stream = Stream(Socket('HELO exa', 'mple.com\r\nQUIT\r\n'))
+        self.assertEqual(stream.readline(), 'HELO example.com\r\n')
+        self.assertEqual(stream.pending, 6)
+        self.assertEqual(stream.readline(), 'QUIT\r\n')
+        self.assertEqual(stream.pending, 0)
+        self.assertEqual(stream.readline(), '')
+
+    def test_readline_partial(self):
+        stream = Stream(Socket('QUIT'))
+        self.assertEqual(stream.readline(), 'QUIT')
+        self.assertEqual(stream.readline(), '')
+
+    def test_write_flushed_before_blocking(self):
+        sock = Socket('RSET\r\nNOOP\r\n', 'QUIT\r\n')
+        stream = Stream(sock)
+        stream.readline()
+        stream.write('250 OK\r\n')
+        stream.readline()
+        stream.write('250 OK\r\n')
+        self.assertEqual(sock.writes, [])
+
+        stream.readline()
+        self.assertEqual(sock.writes, ['250 OK\r\n250 OK\r\n'])
+
+    def test_write_flushed_when_full(self):
+        sock = Socket()
+        stream = Stream(sock, bufsize=8)
+        stream.write('250 OK\r\n')
+        self.assertEqual(sock.writes, ['250 OK\r\n'])
+
+    def test_unread(self):
+        stream = Stream(Socket('DATA\r\n'))
+        stream.readline()
+        stream.unread('QUIT\r\n')
+        self.assertEqual(stream.pending, 6)
+        self.assertEqual(stream.readline(), 'QUIT\r\n')
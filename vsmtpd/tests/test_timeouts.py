@@ -0,0 +1,161 @@
+#
+# vsmtpd/tests/test_timeouts.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import time
+import gevent
+
+from vsmtpd.error import ReapedError, TimeoutError
+from vsmtpd.metrics import metrics
+from vsmtpd.timeouts import DeadlineSweeper
+from vsmtpd.tests.common import TestCase
+
+class Pool(object):
+
+    def __init__(self, size, used):
+        self.size = size
+        self.used = used
+
+    def __len__(self):
+        return self.used
+
+class Waiter(object):
+
+    def __init__(self, deadline, idle_since=None):
+        self.deadline = deadline
+        self.idle_since = idle_since
+        self.timed_out = False
+        self.reaped = False
+        self.greenlet = gevent.spawn(self.wait)
+        gevent.sleep(0)
+
+    def wait(self):
+        try:
+            gevent.sleep(10)
+        except TimeoutError:
+            self.timed_out = True
+        except ReapedError:
+            self.reaped = True
+
+class DeadlineSweeperTestCase(TestCase):
+
+    def setUp(self):
+        self.sweeper = DeadlineSweeper(0.01)
+
+    def test_sweep(self):
+        now = time.time()
+        expired = Waiter(now - 1)
+        waiting = Waiter(now + 60)
+        idle = Waiter(None)
+        for waiter in (expired, waiting, idle):
+            self.sweeper.add(waiter)
+
+        self.sweeper.sweep(now)
+        gevent.sleep(0)
+        self.assertTrue(expired.timed_out)
+        self.assertFalse(waiting.timed_out)
+        self.assertFalse(idle.timed_out)
+
+        waiting.greenlet.kill()
+        idle.greenlet.kill()
+
+    def test_deadline_moved(self):
+        now = time.time()
+        waiter = Waiter(now - 1)
+        self.sweeper.add(waiter)
+        self.sweeper.sweep(now)
+
+        # The connection went on to its next read before the sweep's
+        # callback ran.
+        waiter.deadline = now + 60
+        gevent.sleep(0)
+        self.assertFalse(waiter.timed_out)
+        waiter.greenlet.kill()
+
+    def test_run(self):
+        waiter = Waiter(time.time() + 0.02)
+        self.sweeper.add(waiter)
+        waiter.greenlet.join(1)
+        self.assertTrue(waiter.timed_out)
+
+        self.sweeper.remove(waiter)
+        self.assertEqual(len(self.sweeper), 0)
+
+    def test_overloaded(self):
+        now = time.time()
+        self.sweeper.pool = Pool(10, 8)
+        command = Waiter(now + 25, now - 6)
+        data = Waiter(now + 25)
+        for waiter in (command, data):
+            self.sweeper.add(waiter)
+
+        self.sweeper.sweep(now)
+        gevent.sleep(0)
+        self.assertTrue(self.sweeper.overloaded)
+        self.assertEqual(metrics['connections.occupancy'], 0.8)
+
+        # Only clients waiting on a command get the shorter timeout
+        self.assertTrue(command.timed_out)
+        self.assertFalse(data.timed_out)
+
+        self.sweeper.pool.used = 2
+        self.sweeper.sweep(now)
+        self.assertFalse(self.sweeper.overloaded)
+        data.greenlet.kill()
+
+    def test_reap(self):
+        now = time.time()
+        self.sweeper.pool = Pool(20, 20)
+        reaped = metrics['connections.reaped']
+        oldest = Waiter(now + 60, now - 4)
+        older = Waiter(now + 60, now - 3)
+        newest = Waiter(now + 60, now - 1)
+        data = Waiter(now + 60)
+        waiters = (oldest, older, newest, data)
+        for waiter in waiters:
+            self.sweeper.add(waiter)
+
+        # 20 connections with a watermark of 19 means 1 too many, but
+        # the oldest idle connection will be reaped.
+        self.sweeper.sweep(now)
+        gevent.sleep(0)
+        self.assertEqual([w.reaped for w in waiters],
+                         [True, False, False, False])
+        self.assertEqual(metrics['connections.reaped'], reaped + 1)
+
+        for waiter in waiters[1:]:
+            waiter.greenlet.kill()
+
+    def test_reap_after_read(self):
+        now = time.time()
+        self.sweeper.pool = Pool(10, 10)
+        waiter = Waiter(now + 60, now - 1)
+        self.sweeper.add(waiter)
+        self.sweeper.sweep(now)
+
+        # The command arrived before the callback ran
+        waiter.deadline = waiter.idle_since = None
+        gevent.sleep(0)
+        self.assertFalse(waiter.reaped)
+        waiter.greenlet.kill()
+
+    def tearDown(self):
+        self.sweeper.stop()
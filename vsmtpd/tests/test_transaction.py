@@ -102,9 +102,9 @@ This is testing writing an email"""
         self.assertEqual(self.tnx.body.getvalue(), msg)
 
     def test_body_write_flush(self):
-        self.assertEqual(self.tnx.body.name, None)
+        self.assertFalse(self.tnx.body.on_disk)
         self.tnx.body.write(' ' * (1024 * 512))
-        self.assertNotEqual(self.tnx.body.name, None)
+        self.assertTrue(self.tnx.body.on_disk)
 
     def test_end_headers(self):
         self.tnx.body.write('Subject: blah blah\r\n')
@@ -116,6 +116,18 @@ This is testing writing an email"""
         self.assertTrue(self.tnx.body.body_start > 0)
         self.assertEqual(self.tnx.body.body_start, 132)
 
+    def test_end_headers_detected(self):
+        self.tnx.body.write('Subject: blah blah\r\nFrom: John Smith')
+        self.tnx.body.write(' <john@example.com>\r\n\r')
+        self.tnx.body.write('\nThis is testing writing an email\r\n')
+        self.assertEqual(self.tnx.body.body_start, 59)
+        self.assertEqual(self.tnx.headers['Subject'], 'blah blah')
+
+    def test_end_headers_no_headers(self):
+        self.tnx.body.write('\r\nThis is testing writing an email\r\n')
+        self.assertEqual(self.tnx.body.body_start, 2)
+        self.assertEqual(self.tnx.headers.keys(), [])
+
     def test_body_property(self):
         self.assertNotEqual(self.tnx.body, None)
 
@@ -143,3 +155,55 @@ This is testing writing an email"""
 
     def tearDown(self):
         self.tnx.close()
+
+class TransactionMessageTestCase(TestCase):
+
+    def setUp(self):
+        self.tnx = Transaction(None)
+
+    def test_message(self):
+        body = self.tnx.body
+        body.write('Subject: blah blah\r\n')
+        body.write('Content-Type: multipart/mixed; boundary="XX"\r\n\r\n')
+        body.write('--XX\r\nContent-Type: text/plain\r\n\r\nfirst\r\n')
+        body.write('--XX\r\nContent-Type: text/plain\r\n\r\nsecond\r\n')
+        body.write('--XX--\r\n')
+        pos = body.tell()
+
+        message = self.tnx.message
+        self.assertTrue(message.is_multipart())
+        self.assertEqual(len(message.get_payload()), 2)
+        self.assertTrue(self.tnx.message is message)
+        self.assertEqual(body.tell(), pos)
+
+        # Writing more invalidates the parsed message
+        body.write('epilogue\r\n')
+        self.assertFalse(self.tnx.message is message)
+
+    def test_body_view(self):
+        self.tnx.body.write('Subject: view\r\n\r\n')
+        self.tnx.body.write('This is the body\r\n')
+        view = self.tnx.body_view()
+        self.assertTrue(isinstance(view.data, memoryview))
+        self.assertEqual(view.body_start, 17)
+        self.assertEqual(view.headers.tobytes(), 'Subject: view\r\n\r\n')
+        self.assertEqual(view.body.tobytes(), 'This is the body\r\n')
+
+        # The view stays as it was if the message moves to disk
+        self.tnx.flush()
+        self.assertEqual(len(view), 35)
+        self.assertEqual(view.body.tobytes(), 'This is the body\r\n')
+
+    def test_body_view_file(self):
+        self.tnx.body.write('Subject: view\r\n\r\n')
+        self.tnx.body.write('This is the body\r\n')
+        self.tnx.flush()
+        view = self.tnx.body_view()
+        self.assertEqual(view.data[:7], 'Subject')
+        self.assertEqual(str(view.body), 'This is the body\r\n')
+
+        self.tnx.close()
+        self.assertEqual(len(view), 0)
+
+    def tearDown(self):
+        self.tnx.close()
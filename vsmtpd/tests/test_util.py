@@ -27,6 +27,7 @@ from vsmtpd.util import get_procname
 from vsmtpd.util import set_procname
 from vsmtpd.util import set_cmdline
 from vsmtpd.util import NoteObject
+from vsmtpd.util import TTLCache
 from vsmtpd.tests.common import TestCase
 
 class NoteObjectTestCase(TestCase):
@@ -44,6 +45,30 @@ class NoteObjectTestCase(TestCase):
         self.assertEqual(note.notes['test'], 5)
         self.assertEqual(note.notes['example'], 17)
 
+class TTLCacheTestCase(TestCase):
+
+    def test_get_set(self):
+        cache = TTLCache()
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue('a' in cache)
+
+    def test_expiry(self):
+        cache = TTLCache()
+        cache.set('a', 1, -1)
+        self.assertEqual(cache.get('a', 5), 5)
+        self.assertEqual(len(cache), 0)
+
+    def test_size(self):
+        cache = TTLCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.get('c'), 3)
+
 class ProcessCmdLineTestCase(TestCase):
 
     def setUp(self):
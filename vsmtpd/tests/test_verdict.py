@@ -0,0 +1,67 @@
+#
+# vsmtpd/tests/test_verdict.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+
+from vsmtpd import dsn
+from vsmtpd import error
+from vsmtpd import verdict
+from vsmtpd.tests.common import TestCase
+from vsmtpd.verdict import Verdict
+
+class VerdictTestCase(TestCase):
+
+    def test_flags(self):
+        self.assertTrue(verdict.OK.okay)
+        self.assertTrue(verdict.DONE.done)
+        self.assertFalse(verdict.DENY.soft or verdict.DENY.disconnect)
+        self.assertTrue(verdict.DENYSOFT.soft)
+        self.assertTrue(verdict.DENY_DISCONNECT.disconnect)
+        self.assertTrue(verdict.DENYSOFT_DISCONNECT.soft and
+                        verdict.DENYSOFT_DISCONNECT.disconnect)
+
+    def test_message(self):
+        self.assertTrue(verdict.DENY() is verdict.DENY)
+        denied = verdict.DENY('Go away')
+        self.assertEqual(denied.message, 'Go away')
+        self.assertEqual(denied.code, dsn.DENY)
+        self.assertEqual(verdict.DENY.message, None)
+
+    def test_declined(self):
+        self.assertFalse(verdict.DECLINED)
+        self.assertTrue(verdict.DENY)
+
+    def test_dsn(self):
+        self.assertEqual(Verdict(*dsn.too_many_hops()),
+                         verdict.DENY('Too many hops (#5.4.6)'))
+
+    def test_from_error(self):
+        for exc, expected in (
+                (error.OkayError(), verdict.OK),
+                (error.DoneError(), verdict.DONE),
+                (error.DenyError(), verdict.DENY),
+                (error.DenySoftError(), verdict.DENYSOFT),
+                (error.DenyDisconnectError(), verdict.DENY_DISCONNECT),
+                (error.DenySoftDisconnectError(),
+                 verdict.DENYSOFT_DISCONNECT)):
+            self.assertTrue(Verdict.from_error(exc) is expected)
+        self.assertEqual(Verdict.from_error(error.DenyError('Go away')),
+                         verdict.DENY('Go away'))
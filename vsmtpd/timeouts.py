@@ -0,0 +1,222 @@
+#
+# vsmtpd/timeouts.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import time
+import gevent
+import logging
+
+from vsmtpd.error import ReapedError, TimeoutError
+from vsmtpd.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+class DeadlineSweeper(object):
+    """
+    Enforces the read deadlines of all the connections in a worker.
+
+    Rather than starting and cancelling a timer around every read, a
+    connection just records when its current read has to be finished by
+    in its ``deadline`` attribute. A single greenlet wakes up every
+    ``resolution`` seconds and times out any connection whose deadline
+    has passed, so deadlines are only accurate to within the resolution.
+
+    The per-phase timeouts used by connections are also kept here, a
+    timeout of 0 disables it.
+
+    When given the connection pool, the sweeper also guards against it
+    filling up with idle clients. Once occupancy passes
+    ``overload_watermark`` clients waiting on a command only get
+    ``overload_command`` seconds, and once it passes ``reap_watermark``
+    the clients that have been idle the longest are disconnected to make
+    room. A watermark of 0 disables it.
+
+    :keyword resolution: How often to check deadlines in seconds
+    :type resolution: float
+    :keyword pool: The pool connections are spawned in
+    :type pool: gevent.pool.Pool
+    """
+
+    #: Time allowed for the first command after the greeting
+    greeting = 30
+
+    #: Time allowed for each following command
+    command = 30
+
+    #: Time allowed for each block of message data
+    data_block = 30
+
+    #: Time allowed for the whole of the message data
+    data = 600
+
+    #: Pool occupancy above which command timeouts are shortened
+    overload_watermark = 0.8
+
+    #: Time allowed for a command whilst overloaded
+    overload_command = 5
+
+    #: Pool occupancy above which idle connections are reaped
+    reap_watermark = 0.95
+
+    @property
+    def now(self):
+        """
+        The time as of the last sweep, cheaper than calling time.time()
+        and accurate enough for setting deadlines.
+        """
+        return self._now
+
+    @property
+    def occupancy(self):
+        """
+        How full the connection pool is, from 0 to 1.
+        """
+        if not self.pool or not self.pool.size:
+            return 0.0
+        return len(self.pool) / float(self.pool.size)
+
+    def __init__(self, resolution=1.0, pool=None):
+        self.resolution = resolution
+        self.pool = pool
+        self.overloaded = False
+        self._now = time.time()
+        self._connections = set()
+        self._greenlet = None
+
+    def __len__(self):
+        return len(self._connections)
+
+    def add(self, connection):
+        """
+        Start tracking the deadlines of a connection.
+
+        :param connection: The connection to track
+        :type connection: Connection
+        """
+        if self._greenlet is None:
+            self._now = time.time()
+            self._greenlet = gevent.spawn(self._run)
+        self._connections.add(connection)
+
+    def remove(self, connection):
+        """
+        Stop tracking the deadlines of a connection.
+
+        :param connection: The connection to stop tracking
+        :type connection: Connection
+        """
+        self._connections.discard(connection)
+
+    def stop(self):
+        """
+        Stop the sweeping greenlet.
+        """
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
+
+    def sweep(self, now):
+        """
+        Time out any connections whose deadline is before now and reap
+        idle connections if the pool is close to full.
+
+        :param now: The current time
+        :type now: float
+        """
+        occupancy = self.occupancy
+        metrics.set('connections.occupancy', occupancy)
+        metrics.set('connections.active', len(self._connections))
+
+        overloaded = bool(self.overload_watermark and
+                          occupancy >= self.overload_watermark)
+        if overloaded != self.overloaded:
+            self.overloaded = overloaded
+            if overloaded:
+                log.warning('pool %.0f%% full, shortening timeouts',
+                            occupancy * 100)
+            else:
+                log.info('pool %.0f%% full, no longer overloaded',
+                         occupancy * 100)
+
+        loop = gevent.get_hub().loop
+        idle = []
+        for connection in self._connections:
+            deadline = self.deadline(connection)
+            if deadline is not None and deadline <= now:
+                loop.run_callback(self._expire, connection, now)
+            elif connection.idle_since is not None:
+                idle.append(connection)
+
+        if not (self.reap_watermark and occupancy >= self.reap_watermark):
+            return
+
+        # Disconnect the longest idle connections to bring the pool back
+        # under the watermark.
+        excess = max(1, len(self.pool) -
+                        int(self.pool.size * self.reap_watermark))
+        idle.sort(key=lambda c: c.idle_since)
+        for connection in idle[:excess]:
+            loop.run_callback(self._reap, connection)
+
+    def deadline(self, connection):
+        """
+        Returns the deadline of a connection, taking into account whether
+        the server is overloaded.
+
+        :param connection: The connection
+        :type connection: Connection
+        """
+        deadline = connection.deadline
+        if deadline is None:
+            return None
+
+        idle_since = connection.idle_since
+        if self.overloaded and idle_since is not None:
+            deadline = min(deadline, idle_since + self.overload_command)
+        return deadline
+
+    def _expire(self, connection, now):
+        # The connection may have finished its read since the sweep, in
+        # which case it is no longer waiting and must be left alone.
+        deadline = self.deadline(connection)
+        if deadline is None or deadline > now:
+            return
+
+        greenlet = connection.greenlet
+        if greenlet is not None and not greenlet.dead:
+            metrics.incr('connections.timed_out')
+            greenlet.throw(TimeoutError)
+
+    def _reap(self, connection):
+        # Only connections still waiting on a command are reaped
+        if connection.idle_since is None:
+            return
+
+        greenlet = connection.greenlet
+        if greenlet is not None and not greenlet.dead:
+            metrics.incr('connections.reaped')
+            greenlet.throw(ReapedError)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.resolution)
+            self._now = now = time.time()
+            self.sweep(now)
@@ -22,109 +22,12 @@
 
 import logging
 
-from cStringIO import StringIO
-from email.feedparser import FeedParser
-from email.message import Message as _Message, SEMISPACE
-from tempfile import NamedTemporaryFile
 from vsmtpd.address import Address
+from vsmtpd.spool import BodyView, Spool
 from vsmtpd.util import NoteObject
 
 log = logging.getLogger(__name__)
 
-class Message(_Message):
-
-    def insert_header(self, _pos, _name, _value, **_params):
-        parts = []
-        for k, v in _params.items():
-            if v is None:
-                parts.append(k.replace('_', '-'))
-            else:
-                parts.append(_formatparam(k.replace('_', '-'), v))
-        if _value is not None:
-            parts.insert(0, _value)
-        self._headers.insert(_pos, (_name, SEMISPACE.join(parts)))
-
-class Spool(object):
-    """
-    Thin wrapper around either a file-object or a cStringIO object. Allows
-    use of the body attribute without losing functionality by avoiding
-    the class level methods of the transaction.
-    """
-
-    @property
-    def body_start(self):
-        return self._body_start
-
-    @property
-    def headers(self):
-        return self._headers
-
-    @property
-    def name(self):
-        return self._filename
-
-    def __init__(self):
-        self._body_start = 0
-        self._filename = None
-        self._fp       = StringIO()
-        self._headers  = None
-        self._parser   = FeedParser(Message)
-        self._rollover = 262144 # 256kb
-
-    def __getattr__(self, key):
-        return getattr(self._fp, key)
-
-    def __iter__(self):
-        return iter(self._fp)
-
-    def end_headers(self):
-        """
-        Close off the parser and return the headers.
-        """
-        self._body_start = self._fp.tell()
-        self._headers = self._parser.close()
-        log.debug('headers marked as closed at %d chars', self._body_start)
-        return self._headers
-
-    def flush(self):
-        """
-        Flushes the data held in memory to a temporary file on disk.
-        """
-        # Check to see if the data has been flushed already
-        if self._filename:
-            return
-
-        log.debug('flushing spool to disk')
-
-        # Create the named temporary file to write the data to
-        fp = self._fp
-        newfp = self._fp = NamedTemporaryFile(dir='/tmp', prefix='')
-        if fp:
-            newfp.write(fp.getvalue())
-            newfp.seek(fp.tell(), 0)
-            fp.close()
-
-        self._filename = newfp.name
-
-        log.debug('flushed to disk with name %s', self._filename)
-
-    def write(self, data):
-        """
-        Write data to the end of the email.
-
-        :param data: The data to add to the end of the email
-        :type data: str
-        """
-
-        datalen = len(data)
-        log.debug('writing %d bytes of data', datalen)
-
-        if (self._fp.tell() + datalen) > self._rollover:
-            self.flush()
-
-        self._fp.write(data)
-        self._parser.feed(data)
-
 class Transaction(NoteObject):
     """
     The Transaction class contains all the data relating to a single SMTP
@@ -148,9 +51,25 @@ class Transaction(NoteObject):
         been accessed.
         """
         if not self._body:
-            self._body = Spool()
+            self._body = Spool(size=self.declared_size,
+                               **self._spool_options)
         return self._body
 
+    @property
+    def body_blob(self):
+        """
+        Returns a Blob referencing the body of the message in the shared
+        content-addressed store, or None if there isn't a store. Identical
+        bodies share a single file, so only the first is written out. The
+        reference is released when the transaction is reset, use
+        Blob.link() to keep the body for longer.
+        """
+        store = self._blob_store
+        if self._blob is None and store is not None:
+            digest = self.digests.get('body:' + store.algorithm)
+            self._blob = store.store(self.body_view().body, digest)
+        return self._blob
+
     @property
     def body_filename(self):
         """
@@ -158,17 +77,27 @@ class Transaction(NoteObject):
         useful for virus scanners so that an additional copy doesn't need
         to be made.
 
-        Calling `body_filename` also forces spooling to disk. A message is
-        not spooled to disk if it's size is smaller than
-        config['size_threshold'], default threshold is 0, the sample config
-        file sets this to 10000.
+        Calling `body_filename` moves the message out of memory. Messages
+        no larger than the spool's memfd_limit stay in RAM in a memfd and
+        the name is its /proc/<pid>/fd path, larger ones are spooled to
+        disk, with the file only given a name once this is asked for.
         """
-        # We have to write the email to disk now into our spool directory
-        # and update the body variable.
-        if not self.body.name:
-            self.flush()
+        return self.body.link()
 
-        return self.body.name
+    @property
+    def body_fileno(self):
+        """
+        Returns a file descriptor the message contents can be read from,
+        for handing the message to another process. This moves the
+        message out of memory in the same way as `body_filename`.
+
+        The descriptor is close-on-exec, so it isn't leaked into every
+        process the server starts, and has to be passed to the child
+        explicitly, e.g. as its stdin (after seeking back to the start)
+        or by clearing FD_CLOEXEC in a subprocess preexec_fn.
+        """
+        self.body.link()
+        return self.body.fileno()
 
     @property
     def data_size(self):
@@ -179,6 +108,15 @@ class Transaction(NoteObject):
         """
         return self._body.tell() if self._body else 0
 
+    @property
+    def digests(self):
+        """
+        The digests of the message configured with the spool_digests
+        option, computed as the message was received. A dict of hex
+        digests keyed by name, e.g. 'sha256' or 'body:sha256'.
+        """
+        return self.body.digests
+
     @property
     def headers(self):
         """
@@ -187,6 +125,16 @@ class Transaction(NoteObject):
         """
         return self.body.headers
 
+    @property
+    def message(self):
+        """
+        Returns the whole message parsed into an email.message.Message,
+        including the MIME structure of the body. Parsing the body is
+        expensive so it is only done the first time this is accessed, and
+        changes made to it aren't reflected in the headers or body.
+        """
+        return self.body.parse()
+
     @property
     def recipients(self):
         """
@@ -214,7 +162,13 @@ class Transaction(NoteObject):
         self._recipients = []
         self._sender     = None
         self._body       = None
-        self._body_fn    = None
+        self._blob       = None
+        self._blob_store = getattr(connection, 'blob_store', None)
+        self._views      = []
+        self._spool_options = getattr(connection, 'spool_options', {})
+
+        #: The size of the message given with MAIL FROM, if any
+        self.declared_size = None
 
     def add_recipient(self, recipient):
         """
@@ -231,9 +185,32 @@ class Transaction(NoteObject):
         """
         Dispose all the resources that this transaction has opened.
         """
+        if self._blob:
+            self._blob.release()
+            self._blob = None
+        for view in self._views:
+            view.close()
+        del self._views[:]
         if self._body:
             self._body.close()
 
+    def header_block(self):
+        """
+        Returns the header block of the message to pass on, see
+        Spool.header_block().
+        """
+        return self.body.header_block()
+
+    def body_view(self):
+        """
+        Returns a BodyView of the message, for reading it without making
+        copies. The view covers the message as it is now and remains
+        valid until the transaction is reset.
+        """
+        view = BodyView(self.body.view(), self.body.body_start)
+        self._views.append(view)
+        return view
+
     def end_headers(self):
         """
         Mark the end of the messages headers and the beginning of the
@@ -247,6 +224,27 @@ class Transaction(NoteObject):
         """
         self.body.flush()
 
+    def get_all(self, name, failobj=None):
+        """
+        Returns the values of all the headers with the given name, or
+        failobj if there aren't any.
+
+        :param name: The name of the header, in any case
+        :type name: str
+        :keyword failobj: What to return if there are no such headers
+        :type failobj: object
+        """
+        return self.headers.get_all(name, failobj)
+
+    def header_count(self, name):
+        """
+        Returns the number of headers with the given name.
+
+        :param name: The name of the header, in any case
+        :type name: str
+        """
+        return self.headers.header_count(name)
+
     def remove_recipient(self, recipient):
         """
         Remove a recipient from the mail envelope of this message.
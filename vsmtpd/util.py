@@ -20,7 +20,10 @@
 #   Boston, MA    02110-1301, USA.
 #
 
+import os
 import sys
+import time
+import errno
 import ctypes
 import collections
 
@@ -141,7 +144,136 @@ class NoteObject(object):
             self._notes = {}
         return self._notes
 
-libc = ctypes.cdll.LoadLibrary('libc.so.6')
+class TTLCache(object):
+    """
+    A bounded cache whose entries expire after a time to live. Once the
+    cache is full the oldest entries are discarded to make room.
+
+    :keyword size: The maximum number of entries to hold
+    :type size: int
+    :keyword ttl: The default time to live of an entry in seconds
+    :type ttl: int
+    """
+
+    def __init__(self, size=1024, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, key, default=None):
+        """
+        Get an entry from the cache, returning default if there isn't an
+        entry or it has expired.
+        """
+        try:
+            value, expires = self._entries[key]
+        except KeyError:
+            return default
+
+        if expires < time.time():
+            del self._entries[key]
+            return default
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Add an entry to the cache.
+
+        :param key: The key of the entry
+        :param value: The value of the entry
+        :keyword ttl: The time to live in seconds, defaults to the cache's
+        :type ttl: int
+        """
+        entries = self._entries
+        if key in entries:
+            del entries[key]
+        elif len(entries) >= self.size:
+            entries.popitem(last=False)
+
+        entries[key] = (value, time.time() + (self.ttl if ttl is None
+                                              else ttl))
+
+libc = ctypes.CDLL('libc.so.6', use_errno=True)
+
+#: Flag for os.open() to create an unnamed file in a directory, or None
+#: if the platform doesn't have them.
+if sys.platform.startswith('linux'):
+    O_TMPFILE = getattr(os, 'O_TMPFILE', 020000000 | os.O_DIRECTORY)
+    O_CLOEXEC = getattr(os, 'O_CLOEXEC', 02000000)
+else:
+    O_TMPFILE = None
+    O_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+MFD_CLOEXEC = 0x01
+FALLOC_FL_KEEP_SIZE = 0x01
+AT_FDCWD = -100
+AT_SYMLINK_FOLLOW = 0x400
+
+def fallocate(fd, offset, length):
+    """
+    Allocate disk space for part of a file up front, without changing the
+    size of the file. Returns False if the filesystem doesn't support it.
+
+    :param fd: The file descriptor
+    :type fd: int
+    :param offset: The start of the space to allocate
+    :type offset: int
+    :param length: The amount of space to allocate
+    :type length: int
+    """
+    if libc.fallocate64(fd, FALLOC_FL_KEEP_SIZE, ctypes.c_int64(offset),
+                        ctypes.c_int64(length)) == 0:
+        return True
+
+    err = ctypes.get_errno()
+    if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+        return False
+    raise OSError(err, os.strerror(err))
+
+def memfd_create(name, flags=MFD_CLOEXEC):
+    """
+    Create an anonymous file that lives in memory, returning its file
+    descriptor.
+
+    :param name: The name of the file, only used for debugging
+    :type name: str
+    :keyword flags: The MFD_* flags to create the file with
+    :type flags: int
+    """
+    try:
+        func = libc.memfd_create
+    except AttributeError:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    fd = func(name, flags)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return fd
+
+def link_fd(fd, path):
+    """
+    Give an open file a name, such as one created with O_TMPFILE.
+
+    :param fd: The file descriptor
+    :type fd: int
+    :param path: The name to give it
+    :type path: str
+    """
+    if libc.linkat(AT_FDCWD, '/proc/self/fd/%d' % fd, AT_FDCWD, path,
+                   AT_SYMLINK_FOLLOW) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
 
 def get_procname():
     argv = ctypes.POINTER(ctypes.c_char_p)()
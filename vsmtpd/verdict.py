@@ -0,0 +1,129 @@
+#
+# vsmtpd/verdict.py
+#
+# Copyright (C) 2011 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+
+"""
+Verdicts are how a hook handler can say what should happen to the SMTP
+conversation without raising one of the :class:`vsmtpd.error.HookError`
+exceptions, which is expensive on paths that reject most of the time,
+e.g. RCPT::
+
+    from vsmtpd.verdict import DENY
+
+    @hook
+    def rcpt(self, transaction, rcpt):
+        if self.blocked(rcpt):
+            return DENY('Mailbox unavailable')
+
+The verdicts without a message are allocated once, calling one with a
+message returns a copy carrying it. A verdict is also a ``(code,
+message)`` tuple, so the results of the :mod:`vsmtpd.dsn` functions can
+be turned into one with ``Verdict(*dsn.no_such_user())``.
+"""
+
+from operator import itemgetter
+
+from vsmtpd import dsn
+
+_SOFT       = frozenset([dsn.DENYSOFT, dsn.DENYSOFT_DISCONNECT])
+_DISCONNECT = frozenset([dsn.DENY_DISCONNECT, dsn.DENYSOFT_DISCONNECT])
+
+class Verdict(tuple):
+    """
+    The decision of a hook handler, offering the same ``soft``,
+    ``disconnect``, ``done``, ``okay`` and ``message`` attributes as the
+    :class:`vsmtpd.error.HookError` exceptions.
+
+    :param code: One of the :mod:`vsmtpd.dsn` return codes
+    :type code: int
+    :keyword message: The message to send the client
+    :type message: str
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, code, message=None):
+        return tuple.__new__(cls, (code, message))
+
+    code    = property(itemgetter(0))
+    message = property(itemgetter(1))
+
+    @property
+    def soft(self):
+        return self[0] in _SOFT
+
+    @property
+    def disconnect(self):
+        return self[0] in _DISCONNECT
+
+    @property
+    def done(self):
+        return self[0] == dsn.DONE
+
+    @property
+    def okay(self):
+        return self[0] == dsn.OK
+
+    def __call__(self, message=None):
+        """
+        Return this verdict with a message for the client.
+
+        :keyword message: The message to send the client
+        :type message: str
+        """
+        if not message:
+            return self
+        return Verdict(self[0], message)
+
+    def __nonzero__(self):
+        # A declined verdict lets the remaining handlers run
+        return self[0] != dsn.DECLINED
+
+    def __repr__(self):
+        return 'Verdict(%d, %r)' % self
+
+    @classmethod
+    def from_error(cls, error):
+        """
+        Convert a :class:`vsmtpd.error.HookError` raised by a hook handler
+        into the matching verdict.
+
+        :param error: The raised error
+        :type error: :class:`vsmtpd.error.HookError`
+        """
+        if error.done:
+            verdict = DONE
+        elif error.okay:
+            verdict = OK
+        elif error.soft:
+            verdict = DENYSOFT_DISCONNECT if error.disconnect else DENYSOFT
+        else:
+            verdict = DENY_DISCONNECT if error.disconnect else DENY
+        return verdict(error.message)
+
+OK                  = Verdict(dsn.OK)
+DENY                = Verdict(dsn.DENY)
+DENYSOFT            = Verdict(dsn.DENYSOFT)
+DENY_DISCONNECT     = Verdict(dsn.DENY_DISCONNECT)
+DENYSOFT_DISCONNECT = Verdict(dsn.DENYSOFT_DISCONNECT)
+DECLINED            = Verdict(dsn.DECLINED)
+DONE                = Verdict(dsn.DONE)